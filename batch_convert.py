@@ -0,0 +1,153 @@
+"""Batch convert directory trees between TIM and PNG
+
+Usage:
+    python batch_convert.py to-png textures/ png_out/
+    python batch_convert.py to-tim png_in/ textures/ --bpp 8
+
+Files are converted in parallel across a process pool. Outputs that are
+newer than their source are skipped unless --force is given.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from timedit import TimImage
+
+SOURCE_EXTENSIONS = {
+    "to-png": (".tim",),
+    "to-tim": (".png",),
+}
+TARGET_EXTENSION = {
+    "to-png": ".png",
+    "to-tim": ".tim",
+}
+
+
+def image_to_tim(img, bpp):
+    """Build a TimImage from a PIL image, quantizing to a CLUT for 4/8bpp"""
+    tim = TimImage()
+    tim.bpp = bpp
+
+    if bpp == 16:
+        tim.image = img.convert("RGB")
+    else:
+        num_colors = 16 if bpp == 4 else 256
+        if img.mode == "P" and max(img.getextrema()) < num_colors:
+            quantized = img
+        else:
+            quantized = img.convert("RGB").quantize(colors=num_colors)
+
+        palette = (quantized.getpalette() or [])[:num_colors * 3]
+        palette += [0] * (num_colors * 3 - len(palette))
+        tim.clut = [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+        tim.has_clut = True
+        tim.image = quantized
+
+    tim.width = tim.image.width
+    tim.height = tim.image.height
+    return tim
+
+
+def convert_file(job):
+    """Convert one file; runs in a worker process
+
+    Returns (src, bytes read, seconds taken, error message or None).
+    """
+    mode, src, dst, bpp = job
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        if mode == "to-png":
+            tim = TimImage()
+            tim.load(src)
+            tim.image.save(dst)
+        else:
+            with Image.open(src) as img:
+                tim = image_to_tim(img, bpp)
+            tim.save(dst)
+        error = None
+    except Exception as e:
+        error = str(e)
+    return src, os.path.getsize(src), time.perf_counter() - start, error
+
+
+def collect_jobs(mode, src_root, dst_root, bpp=16, force=False):
+    """Walk src_root and return (jobs, skipped count) for outdated outputs"""
+    extensions = SOURCE_EXTENSIONS[mode]
+    jobs = []
+    skipped = 0
+
+    for dirpath, _, filenames in os.walk(src_root):
+        for name in sorted(filenames):
+            if not name.lower().endswith(extensions):
+                continue
+
+            src = os.path.join(dirpath, name)
+            rel = os.path.relpath(src, src_root)
+            dst = os.path.join(dst_root, os.path.splitext(rel)[0] + TARGET_EXTENSION[mode])
+
+            if not force and os.path.exists(dst) \
+                    and os.path.getmtime(dst) >= os.path.getmtime(src):
+                skipped += 1
+                continue
+
+            jobs.append((mode, src, dst, bpp))
+
+    return jobs, skipped
+
+
+def run(mode, src_root, dst_root, bpp=16, workers=None, force=False, out=sys.stdout):
+    """Convert a directory tree and report per-file throughput
+
+    Returns the number of files that failed to convert.
+    """
+    jobs, skipped = collect_jobs(mode, src_root, dst_root, bpp, force)
+    failed = 0
+    total_bytes = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 8))
+        for src, size, seconds, error in pool.map(convert_file, jobs, chunksize=chunksize):
+            rel = os.path.relpath(src, src_root)
+            if error:
+                failed += 1
+                print(f"FAILED  {rel}: {error}", file=out)
+                continue
+
+            total_bytes += size
+            rate = size / seconds / (1024 * 1024) if seconds else 0.0
+            print(f"{rel}  {size / 1024:.1f} KiB  {seconds * 1000:.1f} ms  {rate:.1f} MiB/s", file=out)
+
+    elapsed = time.perf_counter() - start
+    converted = len(jobs) - failed
+    files_rate = converted / elapsed if elapsed else 0.0
+    bytes_rate = total_bytes / (1024 * 1024) / elapsed if elapsed else 0.0
+    print(f"\n{converted} converted, {skipped} up to date, {failed} failed "
+          f"in {elapsed:.2f}s ({files_rate:.1f} files/s, {bytes_rate:.1f} MiB/s)", file=out)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch convert between TIM and PNG")
+    parser.add_argument("mode", choices=sorted(SOURCE_EXTENSIONS), help="conversion direction")
+    parser.add_argument("src", help="source directory")
+    parser.add_argument("dst", help="destination directory")
+    parser.add_argument("--bpp", type=int, choices=(4, 8, 16), default=16,
+                        help="target bit depth for to-tim (default: 16)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true",
+                        help="convert even when the output is up to date")
+    args = parser.parse_args(argv)
+
+    failed = run(args.mode, args.src, args.dst, args.bpp, args.workers, args.force)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Benchmarks for the codec, compositing, undo and render hot paths
+
+Usage:
+    python benchmark.py                  # run and compare with the baseline
+    python benchmark.py --save-baseline  # record new baseline timings
+    python benchmark.py -k load          # only cases whose name contains "load"
+
+Synthetic TIMs are generated at 4, 8 and 16bpp from 16x16 up to 1024x512.
+Each case reports the best time per call; any case slower than its
+baseline by more than --tolerance makes the run exit with status 1.
+Baselines are machine specific, so record them on the machine that
+checks for regressions.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+from PIL import Image
+
+from layers import LayerStack
+from timedit import TimImage
+from undo_redo import UndoRedoManager
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+SIZES = [(16, 16), (64, 64), (256, 256), (1024, 512)]
+BPPS = [4, 8, 16]
+LAYER_COUNT = 4
+UNDO_DEPTH = 256
+
+
+def make_image(width, height, seed):
+    """Deterministic noisy RGB test image"""
+    rng = random.Random(seed)
+    size = width * height * 3
+    return Image.frombytes("RGB", (width, height), rng.getrandbits(size * 8).to_bytes(size, "little"))
+
+
+def make_tim(width, height, bpp, seed=0):
+    """Synthetic TimImage with a CLUT for the paletted depths"""
+    tim = TimImage()
+    tim.bpp = bpp
+    tim.width = width
+    tim.height = height
+
+    img = make_image(width, height, seed)
+    if bpp == 16:
+        tim.image = img
+    else:
+        num_colors = 16 if bpp == 4 else 256
+        tim.image = img.quantize(colors=num_colors)
+        palette = tim.image.getpalette()[:num_colors * 3]
+        palette += [0] * (num_colors * 3 - len(palette))
+        tim.clut = [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+        tim.has_clut = True
+    return tim
+
+
+def make_layers(width, height):
+    """Layer stack with an opaque background and half-transparent overlays"""
+    stack = LayerStack(width, height)
+    stack.add_layer("Background", make_image(width, height, 0))
+    for i in range(1, LAYER_COUNT):
+        overlay = make_image(width, height, i).convert("RGBA")
+        overlay.putalpha(128)
+        stack.add_layer(f"Layer {i}", overlay)
+    stack.layers[-1].opacity = 0.5
+    return stack
+
+
+def collect_cases(tmp_dir):
+    """Return a list of (name, callable) benchmark cases"""
+    cases = []
+
+    for bpp in BPPS:
+        for width, height in SIZES:
+            tim = make_tim(width, height, bpp)
+            path = os.path.join(tmp_dir, f"{bpp}bpp_{width}x{height}.tim")
+            tim.save(path)
+            size = f"{bpp}bpp/{width}x{height}"
+
+            def load(path=path):
+                TimImage().load(path)
+
+            cases.append((f"TimImage.load {size}", load))
+            cases.append((f"TimImage.encode {size}", tim.encode))
+            cases.append((f"TimImage.build_file {size}", tim.build_file))
+
+    for width, height in SIZES:
+        size = f"{width}x{height}"
+        stack = make_layers(width, height)
+        cases.append((f"LayerStack.flatten {size} x{LAYER_COUNT}", stack.flatten))
+        cases.append((f"LayerStack.get_merged_image {size} x{LAYER_COUNT}", stack.get_merged_image))
+        box = (0, 0, min(width, 32), min(height, 32))
+        cases.append((f"LayerStack.get_merged_image 32x32 of {size} x{LAYER_COUNT}",
+                      lambda stack=stack, box=box: stack.get_merged_image(box)))
+
+        manager = UndoRedoManager()
+
+        def stroke(manager=manager, layer=stack.layers[-1], box=box):
+            manager.begin_stroke(layer)
+            manager.touch(box)
+            manager.end_stroke()
+            # Keep the history bounded, so thousands of timed strokes never
+            # put it under memory pressure or leave compression work
+            # running into the cases after this one
+            if len(manager.history) >= UNDO_DEPTH:
+                manager.clear()
+
+        cases.append((f"UndoRedoManager stroke 32x32 of {size}", stroke))
+
+    cases.extend(collect_render_cases())
+    return cases
+
+
+def collect_render_cases():
+    """ImageViewer.render cases; needs a display, so skipped when there is none"""
+    try:
+        import tkinter as tk
+        from image_viewer import ImageViewer
+        root = tk.Tk()
+    except Exception as e:
+        print(f"skipping ImageViewer.render: {e}", file=sys.stderr)
+        return []
+
+    root.withdraw()
+    viewer = ImageViewer(root)
+    cases = []
+    for width, height in SIZES:
+        img = make_image(width, height, 0)
+
+        def render(img=img):
+            viewer.img = img
+            viewer.render()
+            root.update_idletasks()
+
+        cases.append((f"ImageViewer.render {width}x{height}", render))
+    return cases
+
+
+def time_case(func, repeat):
+    """Best seconds per call over several timing runs"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:8.1f} us"
+    return f"{seconds * 1e3:8.2f} ms"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark TimEdit hot paths")
+    parser.add_argument("-k", dest="filter", default="",
+                        help="only run cases whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timing runs per case (default: 3)")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="fail when slower than baseline by this factor (default: 1.5)")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results as the new baseline")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, func in collect_cases(tmp_dir):
+            if args.filter not in name:
+                continue
+
+            seconds = time_case(func, args.repeat)
+            results[name] = seconds
+
+            line = f"{name:<48} {format_time(seconds)}"
+            if name in baseline:
+                ratio = seconds / baseline[name]
+                line += f"  {ratio:5.2f}x baseline"
+                if ratio > args.tolerance:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line)
+
+    if args.save_baseline:
+        # Keep cases that were filtered out of this run
+        merged = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                merged = json.load(f)
+        merged.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} case(s) slower than {args.tolerance}x baseline:", file=sys.stderr)
+        for name in regressions:
+            print(f"  {name}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
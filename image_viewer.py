@@ -62,6 +62,34 @@ class ImageViewer(tk.Canvas):
         self.delete("all")
         self.create_image(self.pan_x, self.pan_y, anchor="nw", image=self.tkimg)
 
+    def update_region(self, region, box):
+        """Replace the box (x0, y0, x1, y1) of the image with region and redraw only it
+
+        Only the zoomed pixels covering box are resampled and copied into
+        the displayed photo, so the cost follows the box size.
+        """
+        if self.img is None or self.tkimg is None:
+            self.set_image(region)
+            return
+
+        if region.mode != self.img.mode:
+            region = region.convert(self.img.mode)
+        self.img.paste(region, box[:2])
+
+        # Same scale as render(), widened to whole display pixels; resize()
+        # reads the pixels around the box too, so edges match a full render
+        w, h = self.tkimg.width(), self.tkimg.height()
+        sx, sy = w / self.img.width, h / self.img.height
+        dx0, dy0 = int(box[0] * sx), int(box[1] * sy)
+        dx1, dy1 = min(math.ceil(box[2] * sx), w), min(math.ceil(box[3] * sy), h)
+        if dx0 >= dx1 or dy0 >= dy1:
+            return
+
+        patch = self.img.resize((dx1 - dx0, dy1 - dy0), Image.Resampling.LANCZOS,
+                                box=(dx0 / sx, dy0 / sy, dx1 / sx, dy1 / sy))
+        patch_tk = ImageTk.PhotoImage(patch)
+        self.tk.call(str(self.tkimg), "copy", str(patch_tk), "-to", dx0, dy0)
+
     def on_zoom(self, event):
         if event.delta > 0:
             self.zoom *= 1.1
@@ -0,0 +1,161 @@
+"""Index directory trees of TIM files into a queryable SQLite catalogue
+
+Usage:
+    python index_tim.py catalogue.db textures/ more_textures/
+    python index_tim.py catalogue.db --where "bpp = 4 AND x = 640"
+
+Only headers are parsed (plus a hash of the raw pixel data), spread over a
+process pool. Re-runs only re-read files whose size or mtime changed and
+drop rows for files that disappeared.
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from timedit import TimImage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tims (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    bpp INTEGER,
+    width INTEGER,
+    height INTEGER,
+    x INTEGER,
+    y INTEGER,
+    has_clut INTEGER,
+    clut_x INTEGER,
+    clut_y INTEGER,
+    clut_count INTEGER,
+    pixel_hash TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tims_bpp_xy ON tims (bpp, x, y);
+CREATE INDEX IF NOT EXISTS tims_pixel_hash ON tims (pixel_hash);
+"""
+
+COLUMNS = ("path", "size", "mtime_ns", "bpp", "width", "height", "x", "y",
+           "has_clut", "clut_x", "clut_y", "clut_count", "pixel_hash", "error")
+
+
+def index_file(job):
+    """Parse one TIM's header and hash its pixel data; runs in a worker
+
+    Returns a row tuple in COLUMNS order. Files that are not valid TIMs get
+    a row with only the stat fields and the error message filled in.
+    """
+    path, size, mtime_ns = job
+    tim = TimImage()
+    try:
+        with open(path, "rb") as f:
+            if size < 8:
+                raise ValueError("File too small to be TIM")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                pixel_start, pixel_end = tim.parse_header(data)
+                pixel_hash = hashlib.blake2b(data[pixel_start:pixel_end], digest_size=16).hexdigest()
+    except (OSError, ValueError) as e:
+        return (path, size, mtime_ns) + (None,) * 10 + (str(e),)
+
+    return (path, size, mtime_ns, tim.bpp, tim.width, tim.height, tim.x, tim.y,
+            int(tim.has_clut), tim.clut_x, tim.clut_y, len(tim.cluts), pixel_hash, None)
+
+
+def open_catalogue(db_path):
+    """Open (creating if needed) a catalogue database"""
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def collect_jobs(conn, roots):
+    """Walk roots and return (jobs, paths seen) for new or changed files"""
+    known = {path: (size, mtime_ns)
+             for path, size, mtime_ns in conn.execute("SELECT path, size, mtime_ns FROM tims")}
+    jobs = []
+    seen = set()
+
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if not name.lower().endswith(".tim"):
+                    continue
+                path = os.path.abspath(os.path.join(dirpath, name))
+                st = os.stat(path)
+                seen.add(path)
+                if known.get(path) != (st.st_size, st.st_mtime_ns):
+                    jobs.append((path, st.st_size, st.st_mtime_ns))
+
+    return jobs, seen
+
+
+def index(db_path, roots, workers=None, out=sys.stdout):
+    """Bring the catalogue up to date with the given directory trees"""
+    start = time.perf_counter()
+    conn = open_catalogue(db_path)
+
+    jobs, seen = collect_jobs(conn, roots)
+
+    # Forget files under the indexed roots that no longer exist
+    prefixes = tuple(os.path.join(os.path.abspath(root), "") for root in roots)
+    stale = [(path,) for (path,) in conn.execute("SELECT path FROM tims")
+             if path.startswith(prefixes) and path not in seen]
+    conn.executemany("DELETE FROM tims WHERE path = ?", stale)
+
+    failed = 0
+    insert = f"INSERT OR REPLACE INTO tims ({', '.join(COLUMNS)}) " \
+             f"VALUES ({', '.join('?' * len(COLUMNS))})"
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 8))
+            rows = list(pool.map(index_file, jobs, chunksize=chunksize))
+        failed = sum(1 for row in rows if row[-1] is not None)
+        conn.executemany(insert, rows)
+
+    conn.commit()
+    conn.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(jobs)} indexed ({failed} not valid TIMs), "
+          f"{len(seen) - len(jobs)} unchanged, {len(stale)} removed in {elapsed:.2f}s", file=out)
+    return len(jobs)
+
+
+def query(db_path, where, out=sys.stdout):
+    """Print the paths of valid TIMs matching an SQL WHERE clause"""
+    conn = open_catalogue(db_path)
+    try:
+        rows = conn.execute(f"SELECT path FROM tims WHERE error IS NULL AND ({where}) "
+                            "ORDER BY path").fetchall()
+    finally:
+        conn.close()
+
+    for (path,) in rows:
+        print(path, file=out)
+    return len(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index TIM files into an SQLite catalogue")
+    parser.add_argument("db", help="catalogue database file")
+    parser.add_argument("roots", nargs="*", help="directories to index")
+    parser.add_argument("--where", help="print paths matching this SQL condition instead of indexing")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    if args.where:
+        query(args.db, args.where)
+    elif args.roots:
+        index(args.db, args.roots, args.workers)
+    else:
+        parser.error("give directories to index or --where to query")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,265 @@
-from PIL import Image
+from PIL import Image, ImageChops
 import copy
+import functools
+import itertools
+
+from tiles import TiledImage
+
+
+@functools.lru_cache(maxsize=64)
+def _opacity_table(opacity):
+    """point() table for RGBA that scales only the alpha band by opacity"""
+    identity = list(range(256))
+    return identity * 3 + [int(p * opacity) for p in range(256)]
+
+
+# Layer blend modes and their labels; all but "normal" are the PS1 GPU's
+# semi-transparency formulas (B = what lies beneath, F = the layer)
+BLEND_MODES = {
+    "normal": "Normal",
+    "average": "B/2+F/2",
+    "add": "B+F",
+    "subtract": "B-F",
+    "add_quarter": "B+F/4",
+}
+
+_QUARTER = [v >> 2 for v in range(256)] * 3
+
+# Layer versions come from one counter shared by every layer, so a new
+# layer can never match a cache signature recorded for an old one (even
+# one whose id() it reuses)
+_versions = itertools.count(1)
+
+
+def _blend_layer(back, front, mode):
+    """front with its colors replaced by a PS1 blend of back and front
+
+    Both are RGBA images of the same size. The result keeps front's
+    alpha, so alpha compositing it over back applies the blend wherever
+    the layer is opaque and fades it out with the layer's alpha.
+    """
+    b = back.convert("RGB")
+    f = front.convert("RGB")
+    if mode == "average":
+        rgb = ImageChops.add(b, f, scale=2.0)
+    elif mode == "add":
+        rgb = ImageChops.add(b, f)
+    elif mode == "subtract":
+        rgb = ImageChops.subtract(b, f)
+    elif mode == "add_quarter":
+        rgb = ImageChops.add(b, f.point(_QUARTER))
+    else:
+        raise ValueError(f"Unknown blend mode: {mode}")
+    return Image.merge("RGBA", rgb.split() + (front.getchannel("A"),))
+
 
 class Layer:
     """Represents a single layer in the image"""
     
     def __init__(self, name, image, opacity=1.0):
         self.name = name
-        self.image = image.copy() if isinstance(image, Image.Image) else image
+        # Renewed whenever the pixels change, so composites cached by the
+        # layer stack know to rebuild
+        self.version = next(_versions)
+        # (version, opacity) -> display image (or tiles for a tiled layer)
+        self._display = (None, None)
+        # Called to produce the image on first use, for layers whose pixels
+        # are still in a project file (see project.py)
+        self._loader = None
+        # A TiledImage copy shares its tiles, so copying one is cheap
+        self.image = image.copy() if isinstance(image, (Image.Image, TiledImage)) else image
         self.opacity = opacity
+        # One of BLEND_MODES
+        self.blend_mode = "normal"
         self.visible = True
         self.locked = False
     
-    def get_display_image(self):
-        """Get the layer image with opacity applied"""
-        if self.image.mode != 'RGBA':
-            img = self.image.convert('RGBA')
-        else:
-            img = self.image.copy()
+    @property
+    def image(self):
+        if self._loader is not None:
+            self._image = self._loader()
+            self._loader = None
+        return self._image
+    
+    @image.setter
+    def image(self, img):
+        # New pixels replace any still waiting in a project file
+        self._loader = None
+        self._image = img
+        self.version = next(_versions)
+    
+    def mark_dirty(self):
+        """Record that the image was edited in place"""
+        self.version = next(_versions)
+    
+    def get_display_image(self, box=None):
+        """Get the layer image (or the box region of it) with opacity applied
         
+        The full display image is cached until the pixels or the opacity
+        change, so callers must not modify it. A box is cropped from the
+        cache when it is current; otherwise only the box is converted, which
+        keeps repeated small updates to an edited layer cheap.
+        """
+        if isinstance(self.image, TiledImage):
+            # Not cached: that would allocate the full canvas tiles avoid
+            img = self.image.crop(box or (0, 0) + self.image.size)
+            if self.opacity < 1.0:
+                img = img.point(_opacity_table(self.opacity))
+            return img
+        
+        key = (self.version, self.opacity)
+        cached_key, cached = self._display
+        if cached_key == key:
+            return cached if box is None else cached.crop(box)
+        
+        img = self.image if box is None else self.image.crop(box)
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        
+        # An opaque RGBA layer is displayed as is, without a copy
         if self.opacity < 1.0:
-            alpha = img.split()[3] if len(img.split()) > 3 else Image.new('L', img.size, 255)
-            alpha = alpha.point(lambda p: int(p * self.opacity))
-            img.putalpha(alpha)
+            img = img.point(_opacity_table(self.opacity))
         
+        if box is None:
+            self._display = (key, img)
         return img
+    
+    def get_display_tiles(self):
+        """((x, y), tile) pairs with opacity applied, or None if not tiled"""
+        if not isinstance(self.image, TiledImage):
+            return None
+        
+        key = (self.version, self.opacity)
+        if self._display[0] != key:
+            tiles = list(self.image.iter_tiles())
+            if self.opacity < 1.0:
+                table = _opacity_table(self.opacity)
+                tiles = [(dest, tile.point(table)) for dest, tile in tiles]
+            self._display = (key, tiles)
+        return self._display[1]
+
+
+class LayerGroup:
+    """A folder of layers shown as a single layer
+    
+    Children are ordered like LayerStack.layers (first on top) and may be
+    groups themselves. The children's composite is cached and rebuilt only
+    when one of them changes, and the group's version is derived from its
+    children, so the stack's caches notice edits inside it while other
+    groups keep their composites. Blend modes inside a group apply within
+    the group; the group's own opacity and blend mode then apply to the
+    whole composite.
+    """
+    
+    def __init__(self, name, width, height, palette=None, transparent_index=0, opacity=1.0):
+        self.name = name
+        self.opacity = opacity
+        self.blend_mode = "normal"
+        self.visible = True
+        self.locked = False
+        # The children live in a stack of their own, which does the caching
+        self._children = LayerStack(width, height, palette, transparent_index)
+        self._display = (None, None)
+        self._empty = None
+        # Tells this group's version apart from any other's, even when empty
+        self._stamp = next(_versions)
+    
+    @property
+    def layers(self):
+        """The child layers and groups"""
+        return self._children.layers
+    
+    @property
+    def version(self):
+        return (self._stamp,) + tuple((layer.version, layer.visible, layer.opacity, layer.blend_mode)
+                                      for layer in self.layers)
+    
+    def add_layer(self, name, image=None, index=None):
+        """Add a child layer (see LayerStack.add_layer)"""
+        return self._children.add_layer(name, image, index)
+    
+    def add_group(self, name, index=None):
+        """Add a nested group"""
+        return self._children.add_group(name, index)
+    
+    def remove_layer(self, index):
+        """Remove a child; unlike a stack, a group may be left empty"""
+        if 0 <= index < len(self.layers):
+            self.layers.pop(index)
+    
+    def set_palette(self, palette):
+        self._children.set_palette(palette)
+    
+    @property
+    def image(self):
+        """Composite of the visible children (cached; do not modify)
+        
+        RGBA, or a P image of indices when the group is indexed.
+        """
+        children = self._children
+        if children.indexed:
+            image = children._composite_indices("group", self.layers)
+        else:
+            image = children._composite("group", self.layers)
+        if image is None:
+            if self._empty is None:
+                if children.indexed:
+                    self._empty = Image.new('P', (children.width, children.height), children.transparent_index)
+                    self._empty.putpalette(children.palette)
+                else:
+                    self._empty = Image.new('RGBA', (children.width, children.height), (0, 0, 0, 0))
+            image = self._empty
+        return image
+    
+    def mark_dirty(self):
+        """Nothing to do: a group changes when its children do"""
+    
+    def get_display_image(self, box=None):
+        """The children's composite with the group's opacity applied (cached)"""
+        key = (self.version, self.opacity)
+        if self._display[0] != key:
+            img = self.image
+            if img.mode != 'RGBA':
+                img = img.convert('RGBA')
+            if self.opacity < 1.0:
+                img = img.point(_opacity_table(self.opacity))
+            self._display = (key, img)
+        img = self._display[1]
+        return img if box is None else img.crop(box)
+    
+    def get_display_tiles(self):
+        return None
 
 
 class LayerStack:
-    """Manages a stack of layers"""
+    """Manages a stack of layers
+    
+    Given a palette (a flat PIL palette, e.g. a TIM's CLUT) the stack is
+    indexed: its layers are P images holding indices into that palette,
+    one byte per pixel. Pixels equal to transparent_index let the layers
+    beneath show through; opacity and blend modes do not apply to indices.
+    """
     
-    def __init__(self, width, height):
+    def __init__(self, width, height, palette=None, transparent_index=0):
         self.layers = []
         self.width = width
         self.height = height
         self.active_layer_idx = 0
+        self.palette = palette
+        self.transparent_index = transparent_index
+        # "below"/"above" -> (layer signatures, composite) of the layers
+        # under and over the active one
+        self._composites = {}
     
     def add_layer(self, name, image=None, index=None):
-        """Add a new layer"""
-        if image is None:
-            image = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
+        """Add a new layer (empty layers are tiled, see tiles.TiledImage)"""
+        if image is None and self.indexed:
+            image = Image.new('P', (self.width, self.height), self.transparent_index)
+            image.putpalette(self.palette)
+        elif image is None:
+            image = TiledImage((self.width, self.height))
+        elif self.indexed and image.mode != 'P':
+            raise ValueError("Layers of an indexed stack must be P-mode images")
         
         layer = Layer(name, image)
         
@@ -49,6 +270,17 @@ class LayerStack:
         
         return layer
     
+    def add_group(self, name, index=None):
+        """Add an empty layer group (see LayerGroup)"""
+        group = LayerGroup(name, self.width, self.height, self.palette, self.transparent_index)
+        
+        if index is None:
+            self.layers.append(group)
+        else:
+            self.layers.insert(index, group)
+        
+        return group
+    
     def remove_layer(self, index):
         """Remove a layer"""
         if len(self.layers) > 1 and index < len(self.layers):
@@ -56,6 +288,17 @@ class LayerStack:
             if self.active_layer_idx >= len(self.layers):
                 self.active_layer_idx = len(self.layers) - 1
     
+    def walk(self, depth=0, owner=None):
+        """Yield (depth, parent, layer) for every layer and group, top first
+        
+        Groups come just before their children; parent is the stack or
+        group whose layers list holds the layer.
+        """
+        for layer in self.layers:
+            yield depth, owner or self, layer
+            if isinstance(layer, LayerGroup):
+                yield from layer._children.walk(depth + 1, layer)
+    
     def get_active_layer(self):
         """Get the currently active layer"""
         if 0 <= self.active_layer_idx < len(self.layers):
@@ -67,26 +310,181 @@ class LayerStack:
         if 0 <= index < len(self.layers):
             self.active_layer_idx = index
     
+    @property
+    def indexed(self):
+        """True when layers hold palette indices (see the class docstring)"""
+        return self.palette is not None
+    
+    def set_palette(self, palette):
+        """Swap the palette of every P-mode layer (and of an indexed stack)"""
+        if self.indexed:
+            self.palette = palette
+        for layer in self.layers:
+            if isinstance(layer, LayerGroup):
+                layer.set_palette(palette)
+            elif layer.image.mode == "P":
+                layer.image.putpalette(palette)
+                layer.mark_dirty()
+    
     def move_layer(self, old_index, new_index):
         """Move a layer to a different position"""
         if 0 <= old_index < len(self.layers) and 0 <= new_index < len(self.layers):
             layer = self.layers.pop(old_index)
             self.layers.insert(new_index, layer)
     
-    def flatten(self):
-        """Flatten all visible layers into one"""
-        base = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
+    def flatten(self, box=None):
+        """Flatten all visible layers into one
+        
+        The layers below and above the active layer are each composited
+        once and cached until one of them changes (see Layer.version), so
+        redrawing while painting the active layer is a three-way composite.
+        PS1 blend modes depend on what lies beneath, so when a layer above
+        the active one uses one, the layers above are blended one by one.
+        With box=(x0, y0, x1, y1) only that region is composited and
+        returned, so the cost follows the box rather than the canvas.
+        """
+        if self.indexed:
+            return self.flatten_indices(box).convert('RGBA')
+        
+        idx = self.active_layer_idx
+        active = self.get_active_layer()
+        image = self._composite("below", self.layers[idx + 1:])
+        if image is not None:
+            image = image.copy() if box is None else image.crop(box)
+        
+        # Bottom to top
+        run = [active] if active is not None else []
+        above = self.layers[:idx]
+        top = None
+        if all(layer.blend_mode == "normal" for layer in above):
+            top = self._composite("above", above)
+        else:
+            run.extend(reversed(above))
+        
+        for layer in run:
+            if layer.visible:
+                image = self._blend(image, self._layer_region(layer, box), layer.blend_mode)
+        if top is not None:
+            image = self._blend(image, top if box is None else top.crop(box), "normal")
+        
+        if image is None:
+            size = (self.width, self.height) if box is None else (box[2] - box[0], box[3] - box[1])
+            image = Image.new('RGBA', size, (0, 0, 0, 0))
+        return image
+    
+    def flatten_indices(self, box=None):
+        """Flatten an indexed stack into one P image against its palette
+        
+        Cached like flatten(): pasting indices through a "not transparent"
+        mask is associative, so the layers above the active one form one
+        cached image too. Pixels no layer covers keep transparent_index.
+        """
+        idx = self.active_layer_idx
+        active = self.get_active_layer()
+        image = self._composite_indices("below", self.layers[idx + 1:])
+        if image is not None:
+            image = image.copy() if box is None else image.crop(box)
+        
+        if active is not None and active.visible:
+            image = self._paste_indices(image, active.image if box is None else active.image.crop(box))
+        top = self._composite_indices("above", self.layers[:idx])
+        if top is not None:
+            image = self._paste_indices(image, top if box is None else top.crop(box))
+        
+        if image is None:
+            size = (self.width, self.height) if box is None else (box[2] - box[0], box[3] - box[1])
+            image = Image.new('P', size, self.transparent_index)
+        image.putpalette(self.palette)
+        return image
+    
+    def _composite_indices(self, which, layers):
+        """Cached index composite of a run of layers (first in the list on top)"""
+        signature = tuple((layer.version, layer.visible) for layer in layers)
+        cached = self._composites.get(which + " indices")
+        if cached is not None and cached[0] == signature:
+            return cached[1]
         
-        for layer in reversed(self.layers):
+        image = None
+        for layer in reversed(layers):
             if layer.visible:
-                layer_img = layer.get_display_image()
-                base.paste(layer_img, (0, 0), layer_img)
+                image = self._paste_indices(image, layer.image)
+        
+        self._composites[which + " indices"] = (signature, image)
+        return image
+    
+    def _paste_indices(self, image, top):
+        """Paste top's non-transparent indices onto image (None: nothing yet)"""
+        if image is None:
+            return top.copy()
+        table = [255] * 256
+        table[self.transparent_index] = 0
+        mask = Image.frombytes('L', top.size, top.tobytes()).point(table)
+        image.paste(top, (0, 0), mask)
+        return image
+    
+    def _composite(self, which, layers):
+        """Cached composite of a run of layers (first in the list on top)"""
+        signature = tuple((layer.version, layer.visible, layer.opacity, layer.blend_mode)
+                          for layer in layers)
+        cached = self._composites.get(which)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
         
-        return base
+        image = None
+        owned = False  # False while image may still be a layer's cached image
+        for layer in reversed(layers):
+            if not layer.visible:
+                continue
+            
+            tiles = layer.get_display_tiles() if layer.blend_mode == "normal" else None
+            if tiles is None:
+                layer_img = self._fit(layer.get_display_image())
+                if image is None and layer.blend_mode == "normal":
+                    image, owned = layer_img, False
+                else:
+                    image, owned = self._blend(image, layer_img, layer.blend_mode), True
+            elif tiles:
+                # Tiled layers are composited in place, empty tiles skipped
+                if image is None:
+                    image = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
+                elif not owned:
+                    image = image.copy()
+                owned = True
+                for dest, tile in tiles:
+                    image.alpha_composite(tile, dest)
+        
+        self._composites[which] = (signature, image)
+        return image
+    
+    def _blend(self, image, top, mode):
+        """New image with top composited over image (None: nothing yet)"""
+        if image is None:
+            if mode == "normal":
+                return top.copy()
+            image = Image.new('RGBA', top.size, (0, 0, 0, 0))
+        if mode != "normal":
+            top = _blend_layer(image, top, mode)
+        return Image.alpha_composite(image, top)
+    
+    def _layer_region(self, layer, box):
+        """A layer's display image, or the box region of it, at the stack's size"""
+        if box is None:
+            return self._fit(layer.get_display_image())
+        if layer.image.size == (self.width, self.height):
+            return layer.get_display_image(box)
+        return self._fit(layer.get_display_image()).crop(box)
+    
+    def _fit(self, img):
+        """Place a layer image on a canvas of the stack's size if it differs"""
+        if img.size == (self.width, self.height):
+            return img
+        canvas = Image.new('RGBA', (self.width, self.height), (0, 0, 0, 0))
+        canvas.paste(img, (0, 0))
+        return canvas
     
-    def get_merged_image(self):
-        """Get flattened image as RGB"""
-        flat = self.flatten()
+    def get_merged_image(self, box=None):
+        """Get flattened image (or the box region of it) as RGB"""
+        flat = self.flatten(box)
         if flat.mode == 'RGBA':
             # Create white background
             background = Image.new('RGB', flat.size, (255, 255, 255))
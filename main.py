@@ -8,8 +8,11 @@ import os
 from timedit import TimImage
 from image_viewer import ImageViewer
 from tools import DrawingTools, ImageAdjustments
-from layers import LayerStack
+from layers import LayerStack, LayerGroup, BLEND_MODES
+from project import load_project, save_project
+from tim_cache import DecodeCache
 from undo_redo import UndoRedoManager
+from vram import Vram
 
 class TimEditorApp:
     def __init__(self):
@@ -19,10 +22,19 @@ class TimEditorApp:
 
         self.current_tim = None
         self.undo_manager = UndoRedoManager()
+        self.decode_cache = DecodeCache()
         self.current_color = (0, 0, 0)
+        # CLUT index indexed layers are drawn with (see _update_draw_index)
+        self.draw_index = 0
         self.brush_size = 5
         self.current_tool = "pencil"
         self.layers = None
+        # The layer or group picked in the layers panel, which may be inside
+        # a group, and (parent, layer) for each row of the panel
+        self.selected_layer = None
+        self.layer_rows = []
+        # Open VRAM layout windows, as (Vram, ImageViewer) pairs
+        self.vram_views = []
         
         # Create main layout
         self._create_menu()
@@ -30,6 +42,8 @@ class TimEditorApp:
         self._create_ui()
         
         self.root.mainloop()
+        # Remove any undo history spilled to disk
+        self.undo_manager.close()
     
     def _create_menu(self):
         """Create menu bar"""
@@ -40,10 +54,14 @@ class TimEditorApp:
         file_menu.add_command(label="New", command=self.new_image)
         file_menu.add_command(label="Open TIM...", command=self.open_tim)
         file_menu.add_command(label="Open Image...", command=self.open_image)
+        file_menu.add_command(label="Open Project...", command=self.open_project)
         file_menu.add_separator()
         file_menu.add_command(label="Save", command=self.save_tim)
         file_menu.add_command(label="Save As...", command=self.save_tim_as)
         file_menu.add_command(label="Export As...", command=self.export_image)
+        file_menu.add_command(label="Save Project...", command=self.save_project)
+        file_menu.add_separator()
+        file_menu.add_command(label="VRAM Layout...", command=self.show_vram_layout)
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.root.quit)
         menubar.add_cascade(label="File", menu=file_menu)
@@ -62,6 +80,8 @@ class TimEditorApp:
         image_menu.add_command(label="Sharpen", command=self.apply_sharpen)
         image_menu.add_command(label="Grayscale", command=self.apply_grayscale)
         image_menu.add_command(label="Invert Colors", command=self.apply_invert)
+        image_menu.add_separator()
+        image_menu.add_command(label="Palette...", command=self.choose_palette)
         menubar.add_cascade(label="Image", menu=image_menu)
         
         # Help menu
@@ -135,8 +155,16 @@ class TimEditorApp:
         layer_buttons = ttk.Frame(left_panel)
         layer_buttons.pack(fill=tk.X, padx=5, pady=5)
         ttk.Button(layer_buttons, text="+ New", command=self.new_layer).pack(side=tk.LEFT, padx=2)
+        ttk.Button(layer_buttons, text="+ Group", command=self.new_group).pack(side=tk.LEFT, padx=2)
         ttk.Button(layer_buttons, text="- Delete", command=self.delete_layer).pack(side=tk.LEFT, padx=2)
         
+        ttk.Label(left_panel, text="Blend:").pack(anchor=tk.W, padx=5)
+        self.blend_var = tk.StringVar(value=BLEND_MODES["normal"])
+        blend_combo = ttk.Combobox(left_panel, textvariable=self.blend_var, state="readonly",
+                                   values=list(BLEND_MODES.values()), width=18)
+        blend_combo.pack(fill=tk.X, padx=5, pady=5)
+        blend_combo.bind('<<ComboboxSelected>>', self.on_blend_select)
+        
         # Center - Canvas
         canvas_frame = ttk.Frame(main_frame)
         canvas_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -162,8 +190,8 @@ class TimEditorApp:
         if self.current_tim is None or self.layers is None:
             return
         
-        active_layer = self.layers.get_active_layer()
-        if active_layer is None or active_layer.locked:
+        active_layer = self.selected_layer
+        if active_layer is None or active_layer.locked or isinstance(active_layer, LayerGroup):
             return
         
         x, y = int(x), int(y)
@@ -172,13 +200,19 @@ class TimEditorApp:
         
         # Ensure coordinates are within bounds
         if x < 0 or x >= active_layer.image.width or y < 0 or y >= active_layer.image.height:
+            if event == "end":
+                self.undo_manager.end_stroke()
             return
         
-        tools = DrawingTools(active_layer.image)
-        color_rgba = (*self.current_color, 255)
+        tools = DrawingTools(active_layer.image, self.layers.transparent_index,
+                             self.undo_manager.touch)
+        if self.layers.indexed:
+            color_rgba = self.draw_index
+        else:
+            color_rgba = (*self.current_color, 255)
         
         if event == "start":
-            self.undo_manager.save_state(self.layers.flatten())
+            self.undo_manager.begin_stroke(active_layer)
         
         elif event == "drag":
             if self.current_tool == "pencil":
@@ -197,7 +231,13 @@ class TimEditorApp:
             elif self.current_tool == "bucket":
                 tools.bucket_fill(x, y, color_rgba)
         
-        self.viewer.set_image(self.layers.get_merged_image())
+        # Recomposite and redisplay only what the tool touched
+        if tools.dirty is not None:
+            active_layer.mark_dirty()
+            self.viewer.update_region(self.layers.get_merged_image(tools.dirty), tools.dirty)
+        
+        if event == "end":
+            self.undo_manager.end_stroke()
     
     def pick_color(self):
         """Open color picker"""
@@ -205,6 +245,12 @@ class TimEditorApp:
         if color[0]:
             self.current_color = color[0]
             self.color_display.config(bg=color[1])
+            self._update_draw_index()
+    
+    def _update_draw_index(self):
+        """Find the CLUT entry indexed layers are drawn with, after the color or palette changes"""
+        if self.layers is not None and self.layers.indexed:
+            self.draw_index = self.current_tim.nearest_clut_index(self.current_color)
     
     def new_image(self):
         """Create a new image"""
@@ -233,6 +279,7 @@ class TimEditorApp:
                 self.current_tim.bpp = 16
                 
                 self.layers = LayerStack(w, h)
+                self.undo_manager.clear()
                 self.layers.add_layer("Background", img)
                 
                 self.viewer.set_image(img)
@@ -250,18 +297,46 @@ class TimEditorApp:
             messagebox.showwarning("No Image", "Open or create an image first")
             return
         
-        self.layers.add_layer(f"Layer {len(self.layers.layers)}")
+        # A selected group gets the new layer on top of its children, and a
+        # layer inside a group gets it just above itself
+        selected = self.selected_layer
+        parent = self._parent_of(selected)
+        if isinstance(selected, LayerGroup):
+            parent, index = selected, 0
+        elif parent is not None and parent is not self.layers:
+            index = parent.layers.index(selected)
+        else:
+            parent, index = self.layers, None
+        self.selected_layer = parent.add_layer(f"Layer {len(parent.layers)}", index=index)
+        self.refresh_layers_list()
+    
+    def new_group(self):
+        """Add a new layer group"""
+        if self.layers is None:
+            messagebox.showwarning("No Image", "Open or create an image first")
+            return
+        
+        self.layers.add_group(f"Group {len(self.layers.layers)}")
         self.refresh_layers_list()
     
     def delete_layer(self):
-        """Delete the selected layer"""
-        if self.layers is None or len(self.layers.layers) <= 1:
+        """Delete the selected layer (the stack always keeps one top-level entry)"""
+        if self.layers is None:
             return
         
-        idx = self.layers_listbox.curselection()
-        if idx:
-            self.layers.remove_layer(idx[0])
+        parent = self._parent_of(self.selected_layer)
+        if parent is not None:
+            parent.remove_layer(parent.layers.index(self.selected_layer))
+            self.selected_layer = None
             self.refresh_layers_list()
+            self.viewer.set_image(self.layers.get_merged_image())
+    
+    def _parent_of(self, layer):
+        """The stack or group holding a layer listed in the panel (or None)"""
+        for parent, row_layer in self.layer_rows:
+            if row_layer is layer:
+                return parent
+        return None
     
     def on_layer_select(self, event):
         """Handle layer selection"""
@@ -270,15 +345,57 @@ class TimEditorApp:
         
         selection = self.layers_listbox.curselection()
         if selection:
-            self.layers.set_active_layer(selection[0])
+            self._select_layer(self.layer_rows[selection[0]][1])
+            self.blend_var.set(BLEND_MODES[self.selected_layer.blend_mode])
+    
+    def _select_layer(self, layer):
+        """Pick a layer (possibly inside a group) for drawing and editing"""
+        self.selected_layer = layer
+        # The stack caches composites around its active top-level entry,
+        # so make that the one holding the layer
+        top = None
+        for depth, _, row_layer in self.layers.walk():
+            if depth == 0:
+                top = row_layer
+            if row_layer is layer:
+                self.layers.set_active_layer(self.layers.layers.index(top))
+                return
+    
+    def on_blend_select(self, event):
+        """Apply the chosen blend mode to the active layer"""
+        layer = self.selected_layer if self.layers else None
+        if layer is None:
+            return
+        
+        labels = {label: mode for mode, label in BLEND_MODES.items()}
+        layer.blend_mode = labels[self.blend_var.get()]
+        self.viewer.set_image(self.layers.get_merged_image())
     
     def refresh_layers_list(self):
         """Refresh the layers listbox"""
         self.layers_listbox.delete(0, tk.END)
-        if self.layers:
-            for i, layer in enumerate(reversed(self.layers.layers)):
-                status = "✓" if layer.visible else "✗"
-                self.layers_listbox.insert(0, f"{status} {layer.name}")
+        self.layer_rows = []
+        if not self.layers:
+            self.selected_layer = None
+            return
+        
+        # Group children follow their group, indented
+        for depth, parent, layer in self.layers.walk():
+            status = "✓" if layer.visible else "✗"
+            indent = "    " * depth
+            if isinstance(layer, LayerGroup):
+                self.layers_listbox.insert(tk.END, f"{indent}{status} ▸ {layer.name}")
+            else:
+                self.layers_listbox.insert(tk.END, f"{indent}{status} {layer.name}")
+            self.layer_rows.append((parent, layer))
+        
+        # Keep the selection when it is still in the stack
+        if self._parent_of(self.selected_layer) is None:
+            self.selected_layer = self.layers.get_active_layer()
+        self._select_layer(self.selected_layer)
+        for row, (_, layer) in enumerate(self.layer_rows):
+            if layer is self.selected_layer:
+                self.layers_listbox.selection_set(row)
     
     def open_tim(self):
         """Open a TIM file"""
@@ -287,13 +404,16 @@ class TimEditorApp:
             return
 
         try:
-            tim = TimImage()
-            tim.load(path)
+            tim = self.decode_cache.load(path)
             self.current_tim = tim
             
-            # Create layers from loaded image
-            self.layers = LayerStack(tim.width, tim.height)
+            # Create layers from loaded image; paletted TIMs are edited as
+            # indices against their CLUT
+            palette = tim.get_palette() if tim.image.mode == 'P' else None
+            self.layers = LayerStack(tim.width, tim.height, palette=palette)
+            self.undo_manager.clear()
             self.layers.add_layer("Background", tim.image)
+            self._update_draw_index()
             
             self.viewer.set_image(tim.image)
             self.update_info()
@@ -320,6 +440,7 @@ class TimEditorApp:
             self.current_tim.file_path = path
             
             self.layers = LayerStack(img.width, img.height)
+            self.undo_manager.clear()
             self.layers.add_layer("Background", img)
             
             self.viewer.set_image(img)
@@ -328,6 +449,49 @@ class TimEditorApp:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to open image: {str(e)}")
     
+    def open_project(self):
+        """Open a layered project; layer pixels load as layers are shown"""
+        path = filedialog.askopenfilename(filetypes=[("TimEdit projects", "*.timproj")])
+        if not path:
+            return
+        
+        try:
+            self.layers, tim = load_project(path)
+            self.undo_manager.clear()
+            if tim is None:
+                tim = TimImage()
+                tim.bpp = 16
+                tim.width = self.layers.width
+                tim.height = self.layers.height
+            self.current_tim = tim
+            self.current_tim.image = self.layers.get_merged_image()
+            self._update_draw_index()
+            
+            self.viewer.set_image(self.current_tim.image)
+            self.update_info()
+            self.refresh_layers_list()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open project: {str(e)}")
+    
+    def save_project(self):
+        """Save all layers and TIM settings as a project"""
+        if self.layers is None:
+            messagebox.showwarning("No Image", "Open or create an image first")
+            return
+        
+        path = filedialog.asksaveasfilename(
+            defaultextension=".timproj",
+            filetypes=[("TimEdit projects", "*.timproj")]
+        )
+        if not path:
+            return
+        
+        try:
+            save_project(path, self.layers, self.current_tim)
+            messagebox.showinfo("Saved", f"Project saved to {os.path.basename(path)}")
+        except Exception as e:
+            messagebox.showerror("Error", str(e))
+    
     def save_tim(self):
         """Save as TIM file"""
         if not self.current_tim:
@@ -338,8 +502,9 @@ class TimEditorApp:
             return self.save_tim_as()
 
         try:
-            self.current_tim.image = self.layers.get_merged_image()
+            self.current_tim.image = self._image_to_save()
             self.current_tim.save(self.current_tim.file_path)
+            self._refresh_vram_views()
             messagebox.showinfo("Saved", "File saved successfully!")
         except Exception as e:
             messagebox.showerror("Error", str(e))
@@ -358,12 +523,19 @@ class TimEditorApp:
             return
 
         try:
-            self.current_tim.image = self.layers.get_merged_image()
+            self.current_tim.image = self._image_to_save()
             self.current_tim.save(path)
+            self._refresh_vram_views()
             messagebox.showinfo("Saved", "File saved successfully!")
         except Exception as e:
             messagebox.showerror("Error", str(e))
     
+    def _image_to_save(self):
+        """Flattened layers for the TIM; indexed stacks keep their indices"""
+        if self.layers.indexed:
+            return self.layers.flatten_indices()
+        return self.layers.get_merged_image()
+    
     def export_image(self):
         """Export as PNG/JPG"""
         if not self.current_tim:
@@ -383,6 +555,50 @@ class TimEditorApp:
         except Exception as e:
             messagebox.showerror("Error", str(e))
     
+    def show_vram_layout(self):
+        """Show several TIMs placed at their VRAM coordinates"""
+        paths = filedialog.askopenfilenames(filetypes=[("TIM files", "*.tim")])
+        if not paths:
+            return
+
+        vram = Vram()
+        try:
+            for path in paths:
+                # The TIM being edited is placed itself, so saving it
+                # updates the layout
+                current = self.current_tim
+                if (current is not None and current.file_path
+                        and os.path.exists(current.file_path) and os.path.samefile(path, current.file_path)):
+                    tim = current
+                else:
+                    tim = TimImage()
+                    tim.load(path)
+                vram.add(tim)
+            vram.recomposite()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to build VRAM layout: {str(e)}")
+            return
+
+        window = tk.Toplevel(self.root)
+        window.title(f"VRAM Layout ({len(paths)} TIMs)")
+        window.geometry("1040x540")
+        viewer = ImageViewer(window)
+        viewer.set_image(vram.image.copy())
+        
+        view = (vram, viewer)
+        self.vram_views.append(view)
+        window.bind("<Destroy>", lambda e: e.widget is window and view in self.vram_views
+                    and self.vram_views.remove(view))
+    
+    def _refresh_vram_views(self):
+        """Recomposite and redraw only the VRAM regions the saved TIM covers"""
+        for vram, viewer in self.vram_views:
+            if self.current_tim not in vram.tims:
+                continue
+            vram.update(self.current_tim)
+            for rect in vram.recomposite():
+                viewer.update_region(vram.image.crop(rect), rect)
+    
     def adjust_brightness_contrast(self):
         """Adjust brightness and contrast"""
         if self.current_tim is None:
@@ -409,6 +625,7 @@ class TimEditorApp:
                 img = ImageAdjustments.contrast(img, float(contrast_scale.get()))
                 
                 self.layers = LayerStack(img.width, img.height)
+                self.undo_manager.clear()
                 self.layers.add_layer("Adjusted", img)
                 self.viewer.set_image(img)
                 self.refresh_layers_list()
@@ -438,6 +655,7 @@ class TimEditorApp:
                 img = ImageAdjustments.saturation(img, float(sat_scale.get()))
                 
                 self.layers = LayerStack(img.width, img.height)
+                self.undo_manager.clear()
                 self.layers.add_layer("Saturated", img)
                 self.viewer.set_image(img)
                 self.refresh_layers_list()
@@ -456,6 +674,7 @@ class TimEditorApp:
         img = ImageAdjustments.blur(img, radius=3)
         
         self.layers = LayerStack(img.width, img.height)
+        self.undo_manager.clear()
         self.layers.add_layer("Blurred", img)
         self.viewer.set_image(img)
         self.refresh_layers_list()
@@ -469,6 +688,7 @@ class TimEditorApp:
         img = ImageAdjustments.sharpen(img)
         
         self.layers = LayerStack(img.width, img.height)
+        self.undo_manager.clear()
         self.layers.add_layer("Sharpened", img)
         self.viewer.set_image(img)
         self.refresh_layers_list()
@@ -482,6 +702,7 @@ class TimEditorApp:
         img = ImageAdjustments.grayscale(img)
         
         self.layers = LayerStack(img.width, img.height)
+        self.undo_manager.clear()
         self.layers.add_layer("Grayscale", img)
         self.viewer.set_image(img)
         self.refresh_layers_list()
@@ -495,27 +716,60 @@ class TimEditorApp:
         img = ImageAdjustments.invert(img)
         
         self.layers = LayerStack(img.width, img.height)
+        self.undo_manager.clear()
         self.layers.add_layer("Inverted", img)
         self.viewer.set_image(img)
         self.refresh_layers_list()
     
+    def choose_palette(self):
+        """Switch between the palettes stored in the TIM's CLUT"""
+        if self.current_tim is None:
+            return
+        
+        num_palettes = len(self.current_tim.cluts)
+        if num_palettes < 2:
+            messagebox.showinfo("Palette", "This image has only one palette.")
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Palette")
+        dialog.geometry("300x100")
+        
+        tk.Label(dialog, text=f"Palette (0-{num_palettes - 1}):").pack()
+        palette_scale = Scale(dialog, from_=0, to=num_palettes - 1, orient=tk.HORIZONTAL,
+                              command=lambda v: self.set_palette(int(v)))
+        palette_scale.set(self.current_tim.clut_index)
+        palette_scale.pack()
+    
+    def set_palette(self, index):
+        """Make a CLUT palette active, swapping only the palette of P-mode layers"""
+        if index == self.current_tim.clut_index:
+            return
+        
+        self.current_tim.set_active_clut(index)
+        self.layers.set_palette(self.current_tim.get_palette())
+        self._update_draw_index()
+        
+        self.viewer.set_image(self.layers.get_merged_image())
+        self.update_info()
+    
     def undo(self):
         """Undo last action"""
         if not self.undo_manager.can_undo():
             return
         
-        state = self.undo_manager.undo()
-        if state:
-            self.viewer.set_image(state)
+        box = self.undo_manager.undo()
+        if box:
+            self.viewer.update_region(self.layers.get_merged_image(box), box)
     
     def redo(self):
         """Redo last undone action"""
         if not self.undo_manager.can_redo():
             return
         
-        state = self.undo_manager.redo()
-        if state:
-            self.viewer.set_image(state)
+        box = self.undo_manager.redo()
+        if box:
+            self.viewer.update_region(self.layers.get_merged_image(box), box)
     
     def update_info(self):
         """Update image information display"""
@@ -529,6 +783,7 @@ class TimEditorApp:
 Width: {self.current_tim.width}px
 Height: {self.current_tim.height}px
 BPP: {self.current_tim.bpp}
+Palettes: {len(self.current_tim.cluts)}
 Layers: {len(self.layers.layers) if self.layers else 0}
 Color Mode: {'RGBA' if self.current_tim.has_clut else 'RGB'}
 """
@@ -0,0 +1,252 @@
+"""Layered TimEdit project files
+
+A project keeps a whole LayerStack (names, opacity, visibility, lock
+state, blend modes and pixels) plus the TIM settings needed to save it
+back out. The file is a fixed header, the compressed pixel data of each
+layer, then a JSON index:
+
+    header   magic "TIMEDPRJ", version u16, reserved u16,
+             index offset u64, index length u64
+    layers   zlib-compressed pixel blobs; tiled layers store one blob
+             per allocated tile
+    index    JSON describing the stack and where each blob lives;
+             layer groups nest their children's entries
+
+Opening a project reads only the header and index. Each layer's pixels
+are read through a memory map and decompressed the first time the layer
+is used, so hidden layers are never read at all.
+"""
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from PIL import Image
+
+from layers import Layer, LayerGroup, LayerStack
+from tiles import TiledImage
+from timedit import TimImage
+
+MAGIC = b"TIMEDPRJ"
+VERSION = 1
+_HEADER = struct.Struct("<8sHHQQ")
+
+# TimImage attributes stored with a project, so it can be saved as a TIM
+_TIM_FIELDS = ("bpp", "has_clut", "clut_index", "width", "height", "x", "y", "clut_x", "clut_y")
+
+
+class _LayerSource:
+    """Loader for a layer whose pixels are still in a project file"""
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.entry = entry
+
+    def __call__(self):
+        # The map is not kept open, like TimImage's lazy load
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _decode_layer(self.entry, data)
+
+    def blobs(self, data):
+        """The compressed blobs of this layer, as (key, bytes) pairs"""
+        entry = self.entry
+        if entry["mode"] == "tiled":
+            return [((col, row), data[offset:offset + length])
+                    for col, row, offset, length in entry["tiles"]]
+        offset, length = entry["data"]
+        return [(None, data[offset:offset + length])]
+
+
+def _decode_layer(entry, data):
+    """Build a layer image from its index entry and the mapped file"""
+    if entry["mode"] == "tiled":
+        tile_size = entry["tile_size"]
+        tiled = TiledImage(entry["size"], tile_size)
+        for col, row, offset, length in entry["tiles"]:
+            raw = zlib.decompress(data[offset:offset + length])
+            tiled.tiles[(col, row)] = Image.frombytes("RGBA", (tile_size, tile_size), raw)
+        return tiled
+
+    offset, length = entry["data"]
+    img = Image.frombytes(entry["mode"], tuple(entry["size"]), zlib.decompress(data[offset:offset + length]))
+    if entry.get("palette"):
+        img.putpalette(entry["palette"])
+    return img
+
+
+def _layer_blobs(layer, source_data, level):
+    """(entry fields, [(key, compressed bytes)]) for one layer's pixels
+
+    A layer that was never loaded has its compressed blobs copied from the
+    project it came from instead of being decompressed and recompressed.
+    """
+    loader = layer._loader
+    if isinstance(loader, _LayerSource) and loader.path in source_data:
+        entry = {k: v for k, v in loader.entry.items() if k not in ("data", "tiles")}
+        return entry, loader.blobs(source_data[loader.path])
+
+    img = layer.image
+    if isinstance(img, TiledImage):
+        entry = {"mode": "tiled", "size": list(img.size), "tile_size": img.tile_size}
+        blobs = [(key, zlib.compress(tile.tobytes(), level)) for key, tile in sorted(img.tiles.items())]
+        return entry, blobs
+
+    entry = {"mode": img.mode, "size": list(img.size),
+             "palette": img.getpalette() if img.mode == "P" else None}
+    return entry, [(None, zlib.compress(img.tobytes(), level))]
+
+
+def _iter_layers(layers):
+    """Every layer under layers, looking inside groups"""
+    for layer in layers:
+        if isinstance(layer, LayerGroup):
+            yield from _iter_layers(layer.layers)
+        else:
+            yield layer
+
+
+def _write_layers(out, layers, source_data, level):
+    """Write the blobs of layers (and groups) to out, returning their index entries"""
+    entries = []
+    for layer in layers:
+        if isinstance(layer, LayerGroup):
+            entry = {"group": True, "children": _write_layers(out, layer.layers, source_data, level)}
+        else:
+            entry, blobs = _layer_blobs(layer, source_data, level)
+            locations = []
+            for key, blob in blobs:
+                locations.append((key, out.tell(), len(blob)))
+                out.write(blob)
+            if entry["mode"] == "tiled":
+                entry["tiles"] = [[key[0], key[1], offset, length] for key, offset, length in locations]
+            else:
+                entry["data"] = [locations[0][1], locations[0][2]]
+        entry.update(name=layer.name, opacity=layer.opacity, visible=layer.visible,
+                     locked=layer.locked, blend_mode=layer.blend_mode)
+        entries.append(entry)
+    return entries
+
+
+def _rebind_layers(path, layers, entries):
+    """Point still-unloaded layers at the file they were just saved to"""
+    for layer, entry in zip(layers, entries):
+        if isinstance(layer, LayerGroup):
+            _rebind_layers(path, layer.layers, entry["children"])
+        elif isinstance(layer._loader, _LayerSource):
+            layer._loader = _LayerSource(path, entry)
+
+
+def save_project(path, stack, tim=None, level=6):
+    """Write a LayerStack (and optionally its TIM settings) to path
+
+    The file is written next to path and then renamed over it, so a
+    failed save never leaves a truncated project behind. Layers that
+    are still unloaded are then pointed at the new file.
+    """
+    # Open the projects that unloaded layers still live in, so their
+    # blobs can be copied; saving over one of them is safe since the new
+    # file only replaces it at the end
+    sources = {layer._loader.path for layer in _iter_layers(stack.layers)
+               if isinstance(layer._loader, _LayerSource)}
+    files = []
+    source_data = {}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        for source in sources:
+            f = open(source, "rb")
+            files.append(f)
+            source_data[source] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with open(tmp_path, "wb") as out:
+            out.write(bytes(_HEADER.size))
+            entries = _write_layers(out, stack.layers, source_data, level)
+
+            index = {
+                "width": stack.width,
+                "height": stack.height,
+                "active_layer": stack.active_layer_idx,
+                "palette": stack.palette,
+                "transparent_index": stack.transparent_index,
+                "tim": _tim_settings(tim),
+                "layers": entries,
+            }
+            data = json.dumps(index).encode("utf-8")
+            index_offset = out.tell()
+            out.write(data)
+            out.seek(0)
+            out.write(_HEADER.pack(MAGIC, VERSION, 0, index_offset, len(data)))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        for data in source_data.values():
+            data.close()
+        for f in files:
+            f.close()
+
+    os.replace(tmp_path, path)
+
+    _rebind_layers(path, stack.layers, entries)
+
+
+def _tim_settings(tim):
+    if tim is None:
+        return None
+    settings = {name: getattr(tim, name) for name in _TIM_FIELDS}
+    settings["cluts"] = [list(palette) for palette in tim.cluts]
+    settings["raw_clut"] = tim.raw_clut
+    return settings
+
+
+def _read_layers(path, parent, entries):
+    """Add lazily loaded layers (and groups) for index entries to a stack or group"""
+    for entry in entries:
+        if entry.get("group"):
+            layer = parent.add_group(entry["name"])
+            layer.opacity = entry["opacity"]
+            _read_layers(path, layer, entry["children"])
+        else:
+            layer = Layer(entry["name"], None, entry["opacity"])
+            layer._loader = _LayerSource(path, entry)
+            parent.layers.append(layer)
+        layer.visible = entry["visible"]
+        layer.locked = entry["locked"]
+        layer.blend_mode = entry["blend_mode"]
+
+
+def load_project(path):
+    """Open a project, returning (LayerStack, TimImage or None)
+
+    Only the header and index are read here; layer pixels are read on
+    first use of each layer's image. The TimImage carries the saved TIM
+    settings but no image or file path.
+    """
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("File too small to be a project")
+        magic, version, _, index_offset, index_length = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not a TimEdit project")
+        if version > VERSION:
+            raise ValueError(f"Unsupported project version: {version}")
+        f.seek(index_offset)
+        index = json.loads(f.read(index_length))
+
+    stack = LayerStack(index["width"], index["height"], palette=index["palette"],
+                       transparent_index=index["transparent_index"])
+    _read_layers(path, stack, index["layers"])
+    stack.set_active_layer(index["active_layer"])
+
+    tim = None
+    if index["tim"] is not None:
+        tim = TimImage()
+        for name in _TIM_FIELDS:
+            setattr(tim, name, index["tim"][name])
+        tim.cluts = [[tuple(color) for color in palette] for palette in index["tim"]["cluts"]]
+        # Projects saved before STP bits were kept have no raw CLUT words
+        tim.raw_clut = index["tim"].get("raw_clut")
+    return stack, tim
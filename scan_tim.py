@@ -0,0 +1,131 @@
+"""Find TIM images embedded in disc images and archives
+
+Usage:
+    python scan_tim.py GAME.BIN                 # print an offset index
+    python scan_tim.py GAME.BIN --extract out/  # also write each TIM out
+"""
+import argparse
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import namedtuple
+
+from timedit import TimImage
+
+# PS1 VRAM is 1024x512 16-bit words; no image block can be larger
+VRAM_WIDTH = 1024
+VRAM_HEIGHT = 512
+
+# Magic word followed by a flags word using only the BPP (4/8/16) and CLUT bits
+_CANDIDATE = re.compile(rb"\x10\x00\x00\x00[\x00-\x02\x08-\x0a]\x00\x00\x00")
+
+TimEntry = namedtuple("TimEntry", "offset size bpp width height has_clut")
+
+
+def _plausible(data, offset, flags):
+    """Cheap block-size checks that reject most false magic matches"""
+    pos = offset + 8
+
+    if flags & 0x08:
+        if pos + 12 > len(data):
+            return False
+        clut_size, _, _, clut_w, clut_h = struct.unpack_from("<I4H", data, pos)
+        if clut_w == 0 or clut_h == 0 or clut_size != 12 + clut_w * clut_h * 2:
+            return False
+        pos += clut_size
+
+    if pos + 12 > len(data):
+        return False
+    img_size, _, _, w16, h16 = struct.unpack_from("<I4H", data, pos)
+    return (0 < w16 <= VRAM_WIDTH and 0 < h16 <= VRAM_HEIGHT
+            and img_size == 12 + w16 * h16 * 2)
+
+
+def scan(data, align=4):
+    """Yield a TimEntry for every valid TIM found in a buffer
+
+    Candidates are located by the magic/flags pattern, filtered by block-size
+    sanity checks and then validated with TimImage.parse_header, the same
+    logic load uses. Scanning resumes after the end of each TIM found.
+    """
+    pos = 0
+    while True:
+        match = _CANDIDATE.search(data, pos)
+        if match is None:
+            return
+
+        offset = match.start()
+        pos = offset + 1
+        if offset % align:
+            continue
+
+        flags = data[offset + 4]
+        if not _plausible(data, offset, flags):
+            continue
+
+        tim = TimImage()
+        try:
+            _, end = tim.parse_header(data, offset)
+        except ValueError:
+            continue
+
+        yield TimEntry(offset, end - offset, tim.bpp, tim.width, tim.height, tim.has_clut)
+        pos = end
+
+
+def scan_file(path, align=4):
+    """Memory-map a file and return the list of TIMs embedded in it"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return list(scan(data, align))
+
+
+def extract(path, entries, out_dir):
+    """Write each entry of a scan out as a standalone .tim file"""
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.splitext(os.path.basename(path))[0]
+    written = []
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                for entry in entries:
+                    out_path = os.path.join(out_dir, f"{base}_{entry.offset:08X}.tim")
+                    with open(out_path, "wb") as out:
+                        # Slicing the memoryview writes straight from the map
+                        out.write(view[entry.offset:entry.offset + entry.size])
+                    written.append(out_path)
+            finally:
+                view.release()
+
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find TIM images embedded in a file")
+    parser.add_argument("path", help="disc image or archive to scan")
+    parser.add_argument("--align", type=int, default=4,
+                        help="only accept TIMs at offsets with this alignment (default: 4)")
+    parser.add_argument("--extract", metavar="DIR",
+                        help="write every TIM found to DIR")
+    args = parser.parse_args(argv)
+
+    entries = scan_file(args.path, args.align)
+
+    print("offset\tsize\tbpp\twidth\theight\tclut")
+    for entry in entries:
+        print(f"0x{entry.offset:08X}\t{entry.size}\t{entry.bpp}\t"
+              f"{entry.width}\t{entry.height}\t{int(entry.has_clut)}")
+    print(f"{len(entries)} TIM(s) found", file=sys.stderr)
+
+    if args.extract:
+        extract(args.path, entries, args.extract)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+from PIL import Image
+
+TILE_SIZE = 64
+
+
+class TiledImage:
+    """Sparse RGBA image stored as fixed-size tiles
+
+    Tiles that are fully transparent are not stored at all, so memory use
+    follows the painted area rather than the canvas size. copy() shares
+    tiles between the copies; a shared tile is copied the first time
+    either side writes to it.
+    """
+
+    mode = "RGBA"
+
+    def __init__(self, size, tile_size=TILE_SIZE):
+        self.size = tuple(size)
+        self.tile_size = tile_size
+        # (column, row) -> tile image; missing tiles are transparent
+        self.tiles = {}
+        # Keys of tiles this instance may modify in place
+        self._owned = set()
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @classmethod
+    def from_image(cls, img, tile_size=TILE_SIZE):
+        """Split an image into tiles, dropping the transparent ones"""
+        tiled = cls(img.size, tile_size)
+        tiled.paste(img, (0, 0))
+        return tiled
+
+    def copy(self):
+        """Copy sharing every tile until one side writes to it"""
+        other = TiledImage(self.size, self.tile_size)
+        other.tiles = dict(self.tiles)
+        self._owned.clear()
+        return other
+
+    def memory_bytes(self):
+        """Bytes held by the allocated tiles"""
+        return len(self.tiles) * self.tile_size * self.tile_size * 4
+
+    def iter_tiles(self):
+        """Yield ((x, y), tile) for every allocated tile, in pixel coordinates"""
+        t = self.tile_size
+        for (col, row), tile in self.tiles.items():
+            yield (col * t, row * t), tile
+
+    def _keys(self, box):
+        """Tile keys overlapping a box"""
+        t = self.tile_size
+        x0, y0, x1, y1 = box
+        for row in range(max(y0, 0) // t, (min(y1, self.height) + t - 1) // t):
+            for col in range(max(x0, 0) // t, (min(x1, self.width) + t - 1) // t):
+                yield col, row
+
+    def crop(self, box):
+        """Return the box region as an RGBA image, built from the tiles it covers"""
+        x0, y0, x1, y1 = box
+        region = Image.new("RGBA", (x1 - x0, y1 - y0), (0, 0, 0, 0))
+        t = self.tile_size
+        for key in self._keys(box):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                region.paste(tile, (key[0] * t - x0, key[1] * t - y0))
+        return region
+
+    def to_image(self):
+        """The whole canvas as a regular RGBA image"""
+        return self.crop((0, 0) + self.size)
+
+    def paste(self, img, origin):
+        """Write an image into the canvas with its top-left corner at origin
+
+        Only the tiles the image covers are touched. New tiles are
+        allocated only where the image has visible pixels, and tiles left
+        fully transparent are freed.
+        """
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+        x0, y0 = origin
+        t = self.tile_size
+        for key in list(self._keys((x0, y0, x0 + img.width, y0 + img.height))):
+            tx, ty = key[0] * t, key[1] * t
+            # The part of img that lands on this tile
+            covered = (max(x0, tx), max(y0, ty), min(x0 + img.width, tx + t), min(y0 + img.height, ty + t))
+            part = img.crop((covered[0] - x0, covered[1] - y0, covered[2] - x0, covered[3] - y0))
+
+            tile = self.tiles.get(key)
+            if tile is None:
+                if part.getchannel("A").getbbox() is None:
+                    continue
+                tile = Image.new("RGBA", (t, t), (0, 0, 0, 0))
+            elif key not in self._owned:
+                tile = tile.copy()
+
+            tile.paste(part, (covered[0] - tx, covered[1] - ty))
+
+            if tile.getchannel("A").getbbox() is None:
+                self.tiles.pop(key, None)
+                self._owned.discard(key)
+            else:
+                self.tiles[key] = tile
+                self._owned.add(key)
@@ -0,0 +1,171 @@
+from collections import OrderedDict
+from PIL import Image
+import hashlib
+import json
+import os
+import tempfile
+
+from timedit import TimImage
+
+
+class DecodeCache:
+    """Cache of decoded TIMs so repeated loads skip parsing and decoding
+
+    Entries are keyed by path + size + mtime, or by a hash of the file
+    contents with by_content=True (which still reads the file, but finds
+    copies and survives touches). Decoded pixels, together with the raw
+    pixel words incremental saves start from, live in an LRU
+    bounded by max_bytes and, when cache_dir is given, are also written to
+    disk so a warm reopen in a later process is just a file read.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_dir=None, by_content=False):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.by_content = by_content
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, path):
+        """Return a TimImage for path, decoding it only on a cache miss"""
+        key = self._key(path)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self.cache_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is not None:
+            self.hits += 1
+            return self._to_tim(entry, path)
+
+        self.misses += 1
+        tim = TimImage()
+        tim.load(path)
+
+        entry = self._from_tim(tim)
+        self._remember(key, entry)
+        if self.cache_dir:
+            self._write_disk(key, entry)
+        return tim
+
+    def clear(self):
+        """Drop every in-memory entry (the disk cache is left alone)"""
+        self._entries.clear()
+        self._size = 0
+
+    def _key(self, path):
+        if self.by_content:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            return "content:" + digest.hexdigest()
+
+        st = os.stat(path)
+        return f"stat:{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+    def _remember(self, key, entry):
+        """Add an entry to the LRU, evicting the oldest to stay in budget"""
+        size = self._entry_size(entry)
+        if size > self.max_bytes:
+            return
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= self._entry_size(old)
+
+        self._entries[key] = entry
+        self._size += size
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= self._entry_size(evicted)
+
+    @staticmethod
+    def _entry_size(entry):
+        _, pixels, raw = entry
+        return len(pixels) + len(raw)
+
+    def _from_tim(self, tim):
+        """Snapshot everything load() produces as (metadata, pixels, raw words)"""
+        img = tim.image
+        meta = {
+            "bpp": tim.bpp,
+            "has_clut": tim.has_clut,
+            "cluts": [list(palette) for palette in tim.cluts],
+            "clut_index": tim.clut_index,
+            "width": tim.width,
+            "height": tim.height,
+            "x": tim.x,
+            "y": tim.y,
+            "clut_x": tim.clut_x,
+            "clut_y": tim.clut_y,
+            "mode": img.mode,
+            "size": list(img.size),
+            "palette": img.getpalette() if img.mode == "P" else None,
+            "pixel_range": list(tim._pixel_range),
+            "raw_clut": tim.raw_clut,
+        }
+        return meta, img.tobytes(), bytes(tim.raw_pixels)
+
+    def _to_tim(self, entry, path):
+        """Rebuild a TimImage from a cache entry without decoding"""
+        meta, pixels, raw = entry
+        tim = TimImage()
+        for name in ("bpp", "has_clut", "clut_index", "width", "height",
+                     "x", "y", "clut_x", "clut_y"):
+            setattr(tim, name, meta[name])
+        tim.cluts = [[tuple(color) for color in palette] for palette in meta["cluts"]]
+        tim.raw_clut = meta["raw_clut"]
+
+        img = Image.frombytes(meta["mode"], tuple(meta["size"]), pixels)
+        if meta["palette"] is not None:
+            img.putpalette(meta["palette"])
+        tim.image = img
+        tim.file_path = path
+        tim._set_raw_pixels(raw)
+        tim._pixel_range = tuple(meta["pixel_range"])
+        return tim
+
+    def _disk_path(self, key):
+        name = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, name + ".tdc")
+
+    def _read_disk(self, key):
+        """Read an entry written by _write_disk: a JSON header line, pixels, raw words"""
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # A hash collision or stale file must never be served
+        if meta.get("key") != key or "raw_size" not in meta or "raw_clut" not in meta:
+            return None
+        split = len(data) - meta["raw_size"]
+        return meta, data[:split], data[split:]
+
+    def _write_disk(self, key, entry):
+        meta, pixels, raw = entry
+        header = json.dumps(dict(meta, key=key, raw_size=len(raw))).encode("utf-8") + b"\n"
+
+        # Write to a temp file and rename so readers never see half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(pixels)
+                f.write(raw)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
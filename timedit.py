@@ -1,33 +1,323 @@
-from PIL import Image
+from PIL import Image, ImageChops
+import asyncio
+import functools
+import mmap
+import os
+import shutil
 import struct
 
+# Lookup tables for bulk 5551 decoding. A pixel word is split into its low
+# and high bytes; red lives in the low byte, blue in the high byte and green
+# straddles both. Each table expands 5 bits to 8 by bit replication, and the
+# two green halves occupy disjoint bits so they can simply be added.
+_R_FROM_LO = bytes(((b & 0x1F) << 3) | ((b & 0x1F) >> 2) for b in range(256))
+_B_FROM_HI = bytes((((b >> 2) & 0x1F) << 3) | (((b >> 2) & 0x1F) >> 2) for b in range(256))
+_G_FROM_LO = bytes(((b >> 5) << 3) | (b >> 7) for b in range(256))
+_G_FROM_HI = bytes(((b & 0x03) << 6) | ((b & 0x03) << 1) for b in range(256))
+
+# Lookup tables for bulk 5551 encoding, the inverse of the above: each 8-bit
+# channel is truncated to 5 bits and shifted into its place in the low or
+# high byte of the word. The alpha/STP bit is left clear.
+_LO_FROM_R = bytes(b >> 3 for b in range(256))
+_LO_FROM_G = bytes(((b >> 3) & 0x07) << 5 for b in range(256))
+_HI_FROM_G = bytes(b >> 6 for b in range(256))
+_HI_FROM_B = bytes((b >> 3) << 2 for b in range(256))
+
+# What an 8-bit channel reads back as after a 5551 encode and decode
+_THROUGH_5551 = bytes(_R_FROM_LO[b >> 3] for b in range(256))
+
+# Swaps the nibbles of every byte (TIM stores the leftmost 4-bit pixel low)
+_NIBBLE_SWAP = bytes(((b & 0x0F) << 4) | (b >> 4) for b in range(256))
+
+
+def _through_5551(img):
+    """An image as RGB with every channel rounded through 5551"""
+    # One translate of the interleaved bytes; point() would rebuild its
+    # table in Python on every call
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return Image.frombytes("RGB", img.size, img.tobytes().translate(_THROUGH_5551))
+
+
+def _encode_words(img):
+    """Encode an RGB image to little-endian 5551 words in one pass"""
+    # Build the low and high byte planes of every word at once, then let
+    # PIL interleave them
+    r, g, b = (band.tobytes() for band in img.split())
+    size = img.size
+    lo = ImageChops.add(
+        Image.frombytes("L", size, r.translate(_LO_FROM_R)),
+        Image.frombytes("L", size, g.translate(_LO_FROM_G)),
+    )
+    hi = ImageChops.add(
+        Image.frombytes("L", size, g.translate(_HI_FROM_G)),
+        Image.frombytes("L", size, b.translate(_HI_FROM_B)),
+    )
+    return Image.merge("LA", (lo, hi)).tobytes()
+
+
+def _lower_envelope(f):
+    """1D squared distance transform of f (None marks an empty cell)
+
+    Returns, for every position p, the q minimising (p - q)^2 + f[q], or
+    None when f has no finite cells (Felzenszwalb & Huttenlocher).
+    """
+    v = []  # cells whose parabolas form the lower envelope
+    z = []  # left boundary of each parabola's segment
+    for q, fq in enumerate(f):
+        if fq is None:
+            continue
+        while v:
+            p = v[-1]
+            s = ((fq + q * q) - (f[p] + p * p)) / (2 * (q - p))
+            if s > z[-1]:
+                break
+            v.pop()
+            z.pop()
+        else:
+            s = float("-inf")
+        v.append(q)
+        z.append(s)
+
+    if not v:
+        return None
+
+    nearest = []
+    k = 0
+    for p in range(len(f)):
+        while k + 1 < len(v) and z[k + 1] < p:
+            k += 1
+        nearest.append(v[k])
+    return nearest
+
+
+@functools.lru_cache(maxsize=32)
+def _nearest_clut_table(palette):
+    """Nearest-CLUT-index table covering every PS1 color
+
+    palette is a tuple of (r, g, b) colors. Returns a 65536-entry list that
+    maps a 5551 word (either STP bit) to the index of the closest palette
+    color, measured in 15-bit color space where the CLUT is stored. Tables
+    are cached per palette, so repeated saves against a CLUT reuse them.
+    """
+    # The 32x32x32 grid is indexed like a 5551 word: r | g << 5 | b << 10.
+    # Palette colors are grid points, so an exact Euclidean distance
+    # transform with labels, done one axis at a time, finds every nearest.
+    dist = [None] * 32768
+    label = [0] * 32768
+    for index, (r, g, b) in enumerate(palette):
+        cell = (r >> 3) | ((g >> 3) << 5) | ((b >> 3) << 10)
+        if dist[cell] is None:
+            dist[cell] = 0
+            label[cell] = index
+
+    for stride in (1, 32, 1024):
+        starts = [i for i in range(32768) if not (i // stride) % 32]
+        new_dist = [None] * 32768
+        new_label = [0] * 32768
+        for start in starts:
+            cells = range(start, start + 32 * stride, stride)
+            nearest = _lower_envelope([dist[c] for c in cells])
+            if nearest is None:
+                continue
+            for p, cell in enumerate(cells):
+                src = cells[nearest[p]]
+                new_dist[cell] = dist[src] + (p - nearest[p]) ** 2
+                new_label[cell] = label[src]
+        dist, label = new_dist, new_label
+
+    return label * 2
+
+
 class TimImage:
     def __init__(self):
         self.bpp = 0
         self.has_clut = False
-        self.clut = []
+        # Every palette in the CLUT block (one per row) and the active one
+        self.cluts = []
+        self.clut_index = 0
         self.width = 0
         self.height = 0
+        # VRAM placement of the image and CLUT blocks (in 16-bit words)
+        self.x = 0
+        self.y = 0
+        self.clut_x = 0
+        self.clut_y = 0
+        # CLUT words as last read or written; entries whose color is
+        # unchanged are written back from these, keeping their STP bits
+        self.raw_clut = None
         self.image = None
         self.file_path = None
+        self._pixel_range = None
+        # Pixel words as last read or written, and the (bpp, width, height)
+        # they describe; encoding starts from these so untouched pixels
+        # round-trip bit-exact
+        self.raw_pixels = None
+        self._raw_geometry = None
+        self._raw_image = None
 
-    def load(self, path):
-        """Load a TIM file"""
+    @property
+    def image(self):
+        """The decoded PIL image, decoded on first access after a lazy load"""
+        if self._image is None and self._pending_pixels is not None:
+            self.image = self._decode_pending()
+        return self._image
+
+    @image.setter
+    def image(self, img):
+        self._image = img
+        self._pending_pixels = None
+
+    @property
+    def clut(self):
+        """The active palette as a list of (r, g, b) tuples"""
+        if 0 <= self.clut_index < len(self.cluts):
+            return self.cluts[self.clut_index]
+        return []
+
+    @clut.setter
+    def clut(self, colors):
+        if self.cluts:
+            self.cluts[self.clut_index] = list(colors)
+        else:
+            self.cluts = [list(colors)] if colors else []
+            self.clut_index = 0
+
+    def get_palette(self):
+        """Flat PIL palette of the active CLUT, padded to the BPP's color count"""
+        return self._build_palette(16 if self.bpp == 4 else 256)
+
+    def set_active_clut(self, index):
+        """Switch the active palette without re-decoding any pixels
+
+        A decoded P-mode image only has its palette replaced, so this costs
+        O(palette size) regardless of the image size.
+        """
+        if not 0 <= index < len(self.cluts):
+            raise IndexError(f"CLUT index {index} out of range ({len(self.cluts)} palettes)")
+
+        self.clut_index = index
+        if self._image is not None and self._image.mode == "P":
+            self._image.putpalette(self.get_palette())
+
+    @property
+    def is_decoded(self):
+        """True unless pixel data from a lazy load is still waiting to be decoded"""
+        return self._pending_pixels is None
+
+    def load(self, path, lazy=False):
+        """Load a TIM file
+
+        With lazy=True only the header, CLUT and image block geometry are
+        parsed (through a memory map); the pixels are decoded on first
+        access to image.
+        """
         self.file_path = path
 
+        if not lazy:
+            self._load_data(_read_file(path))
+            return
+
         with open(path, "rb") as f:
-            data = f.read()
+            if os.fstat(f.fileno()).st_size < 8:
+                raise ValueError("File too small to be TIM")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                pixel_start, pixel_end = self.parse_header(data)
+
+        # The map is not kept open: holding one descriptor per lazily loaded
+        # file would not scale to indexing thousands of them
+        self._pixel_range = (pixel_start, pixel_end)
+        self.raw_pixels = None
+        self._raw_geometry = None
+        self._raw_image = None
+        self.image = None
+        self._pending_pixels = (pixel_start, pixel_end)
+
+    def _load_data(self, data):
+        """Parse and decode a whole TIM file already read into memory"""
+        pixel_start, pixel_end = self.parse_header(data)
+        self._pixel_range = (pixel_start, pixel_end)
+        self._set_raw_pixels(data[pixel_start:pixel_end])
+        self.image = self._decode_pixels(self.raw_pixels, self.width, self.height, self.bpp)
+
+    @classmethod
+    async def load_async(cls, path, executor=None):
+        """Load a TIM file without blocking the event loop
+
+        The file is read on the loop's default thread pool and decoded on
+        executor (default: the same pool, in the same job). Pass a
+        ProcessPoolExecutor to spread decoding over every core at the cost
+        of pickling the result.
+        """
+        loop = asyncio.get_running_loop()
+        if executor is None:
+            return await loop.run_in_executor(None, _tim_from_data, cls, path)
+        data = await loop.run_in_executor(None, _read_file, path)
+        return await loop.run_in_executor(executor, _tim_from_data, cls, path, data)
+
+    def _decode_pending(self):
+        """Decode the pixel range remembered by a lazy load"""
+        pixel_start, pixel_end = self._pending_pixels
+        with open(self.file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < pixel_end:
+                raise ValueError("Pixel data extends beyond file")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self._set_raw_pixels(data[pixel_start:pixel_end])
+        return self._decode_pixels(self.raw_pixels, self.width, self.height, self.bpp)
+
+    def _set_raw_pixels(self, raw_data):
+        """Remember pixel words for the current geometry, padded like a decode"""
+        line_size = self._scanline_words() * 2
+        self.raw_pixels = bytearray(self._word_buffer(raw_data, line_size * self.height))
+        self._raw_geometry = (self.bpp, self.width, self.height)
+        self._raw_image = None
 
+    def iter_bands(self, band_height=64):
+        """Yield (y, band) pairs decoded straight from the loaded file
+
+        Each band is a PIL image of up to band_height scanlines, so memory
+        use is bounded by the band size instead of the whole image. After a
+        lazy load this never decodes the full image.
+        """
+        if self._pixel_range is None or self.file_path is None:
+            raise ValueError("No TIM file loaded")
+        if band_height < 1:
+            raise ValueError("Band height must be at least 1")
+
+        pixel_start, pixel_end = self._pixel_range
+        line_size = self._scanline_words() * 2
+        remaining = max(pixel_end - pixel_start, 0)
+
+        with open(self.file_path, "rb") as f:
+            f.seek(pixel_start)
+            for y in range(0, self.height, band_height):
+                rows = min(band_height, self.height - y)
+                # A short read is padded with zero words, as in a full decode
+                raw = f.read(min(rows * line_size, remaining))
+                remaining -= len(raw)
+                yield y, self._decode_pixels(raw, self.width, rows, self.bpp)
+
+    def iter_rows(self):
+        """Yield (y, row) pairs, one decoded scanline at a time"""
+        return self.iter_bands(1)
+
+    def parse_header(self, data, start=0):
+        """Parse the header and CLUT of a TIM starting at data[start]
+
+        data may be any buffer (bytes, mmap, memoryview), so TIMs embedded in
+        larger files can be validated in place. Sets bpp, CLUT and dimensions
+        without decoding pixels and returns the (start, end) offsets of the
+        pixel data; raises ValueError if the data is not a valid TIM.
+        """
         # Check magic number
-        if len(data) < 8:
+        if len(data) - start < 8:
             raise ValueError("File too small to be TIM")
         
-        magic = struct.unpack("<I", data[0:4])[0]
+        magic, flags = struct.unpack_from("<II", data, start)
         if magic != 0x00000010:
             raise ValueError(f"Not a valid TIM file (magic: {hex(magic)})")
 
         # Parse flags
-        flags = struct.unpack("<I", data[4:8])[0]
         self.has_clut = bool(flags & 0x08)
         bpp_flag = flags & 0x03
 
@@ -40,26 +330,36 @@ class TimImage:
         else:
             raise ValueError(f"Unsupported BPP flag: {bpp_flag}")
 
-        offset = 8
+        offset = start + 8
 
         # Load color lookup table if present
+        self.raw_clut = None
         if self.has_clut:
-            if offset + 4 > len(data):
+            if offset + 12 > len(data):
                 raise ValueError("Invalid CLUT block")
-            
-            clut_size = struct.unpack("<I", data[offset:offset+4])[0]
+
+            clut_size, self.clut_x, self.clut_y, clut_w, clut_h = \
+                struct.unpack_from("<I4H", data, offset)
             if offset + clut_size > len(data):
                 raise ValueError("CLUT block extends beyond file")
             
             clut_start = offset + 12
-            num_colors = (clut_size - 12) // 2
+            num_colors = max(clut_size - 12, 0) // 2
             
-            self.clut = []
-            for i in range(num_colors):
-                color_offset = clut_start + i * 2
-                color_word = struct.unpack("<H", data[color_offset:color_offset+2])[0]
-                rgb = self._decode5551(color_word)
-                self.clut.append(rgb)
+            colors = []
+            if num_colors:
+                color_words = struct.unpack_from(f"<{num_colors}H", data, clut_start)
+                colors = [self._decode5551(word) for word in color_words]
+                self.raw_clut = list(color_words)
+
+            # Each CLUT row holding a full palette is a separate palette;
+            # anything else is read as one palette, as it always was
+            palette_size = 16 if self.bpp == 4 else 256
+            if clut_h > 1 and clut_w >= palette_size and clut_w * clut_h == num_colors:
+                self.cluts = [colors[i:i + clut_w] for i in range(0, num_colors, clut_w)]
+            else:
+                self.cluts = [colors] if colors else []
+            self.clut_index = 0
             
             offset += clut_size
 
@@ -67,8 +367,8 @@ class TimImage:
         if offset + 12 > len(data):
             raise ValueError("Invalid image block header")
         
-        img_size = struct.unpack("<I", data[offset:offset+4])[0]
-        x, y, w16, h16 = struct.unpack("<4H", data[offset+4:offset+12])
+        img_size = struct.unpack_from("<I", data, offset)[0]
+        self.x, self.y, w16, h16 = struct.unpack_from("<4H", data, offset + 4)
         
         # w16 and h16 are texture memory dimensions (in 16-bit word units)
         # Calculate actual pixel dimensions based on BPP
@@ -94,10 +394,7 @@ class TimImage:
         if pixel_data_start + pixel_data_size > len(data):
             raise ValueError("Pixel data extends beyond file")
         
-        raw_pixels = data[pixel_data_start:pixel_data_start + pixel_data_size]
-        
-        # Decode pixels
-        self.image = self._decode_pixels(raw_pixels, self.width, self.height, self.bpp)
+        return pixel_data_start, pixel_data_start + pixel_data_size
 
     def _decode5551(self, color_word):
         """Decode a 5551 color word to RGB"""
@@ -113,6 +410,28 @@ class TimImage:
         b5 = (b >> 3) & 0x1F
         return (b5 << 10) | (g5 << 5) | r5
 
+    def _scanline_words(self):
+        """Width of one scanline in 16-bit words, as stored in the block header"""
+        return (self.width * self.bpp + 15) // 16
+
+    def nearest_clut_index(self, color):
+        """Index of the active CLUT entry closest to an (r, g, b) color"""
+        num_colors = 16 if self.bpp == 4 else 256
+        table = _nearest_clut_table(tuple(self.clut[:num_colors]))
+        return table[self._encode5551(*color[:3])]
+
+    def _remap_to_clut(self, img, num_colors):
+        """Map an image onto the active CLUT through the cached 15-bit table"""
+        table = _nearest_clut_table(tuple(self.clut[:num_colors]))
+
+        words = _encode_words(img.convert("RGB"))
+        keys = Image.frombytes("I", img.size, words, "raw", "I;16")
+        indices = keys.point(table, "L")
+
+        indexed = Image.frombytes("P", img.size, indices.tobytes())
+        indexed.putpalette(self.get_palette())
+        return indexed
+
     def _decode_pixels(self, raw_data, width, height, bpp):
         """Decode raw pixel data based on bit depth"""
         if bpp == 16:
@@ -124,220 +443,427 @@ class TimImage:
         else:
             raise ValueError(f"Unsupported BPP: {bpp}")
 
+    def _word_buffer(self, raw_data, size):
+        """Return exactly size bytes of pixel data, padding a short read with zero words"""
+        # A trailing odd byte is not a whole word, so it decodes as zero too
+        usable = min(len(raw_data) & ~1, size)
+        data = bytes(raw_data[:usable])
+        if usable < size:
+            data += bytes(size - usable)
+        return data
+
+    def _build_palette(self, num_colors):
+        """Build a flat PIL palette from the CLUT, padded to num_colors entries"""
+        if not self.clut:
+            return list(range(num_colors)) * 3
+
+        palette = []
+        for r, g, b in self.clut:
+            palette.extend([r, g, b])
+        while len(palette) < num_colors * 3:
+            palette.extend([0, 0, 0])
+        return palette
+
     def _decode_16bit(self, raw_data, width, height):
         """Decode 16-bit direct color - matching pPainter algorithm exactly"""
-        # pPainter reads sequentially, one word per pixel
-        pixel_data = []
-        offset = 0
-        
-        for y in range(height):
-            for x in range(width):
-                if offset + 1 < len(raw_data):
-                    color_word = struct.unpack("<H", raw_data[offset:offset+2])[0]
-                    r = (color_word >> 0) & 0x1F
-                    g = (color_word >> 5) & 0x1F
-                    b = (color_word >> 10) & 0x1F
-                    # Expand 5-bit to 8-bit
-                    r = (r << 3) | (r >> 2)
-                    g = (g << 3) | (g >> 2)
-                    b = (b << 3) | (b >> 2)
-                    pixel_data.append((r, g, b))
-                else:
-                    pixel_data.append((0, 0, 0))
-                offset += 2
-        
-        img = Image.new("RGB", (width, height))
-        img.putdata(pixel_data)
-        return img
+        # pPainter reads sequentially, one word per pixel. The whole buffer is
+        # decoded at once: each word is split into its low and high bytes and
+        # every channel is rebuilt through 256-entry lookup tables.
+        data = self._word_buffer(raw_data, width * height * 2)
+        lo = data[0::2]
+        hi = data[1::2]
+
+        size = (width, height)
+        r = Image.frombytes("L", size, lo.translate(_R_FROM_LO))
+        b = Image.frombytes("L", size, hi.translate(_B_FROM_HI))
+        g = ImageChops.add(
+            Image.frombytes("L", size, lo.translate(_G_FROM_LO)),
+            Image.frombytes("L", size, hi.translate(_G_FROM_HI)),
+        )
+        return Image.merge("RGB", (r, g, b))
 
     def _decode_8bit(self, raw_data, width, height):
         """Decode 8-bit paletted color - matching pPainter algorithm exactly"""
-        # Create palette
-        if not self.clut:
-            palette = list(range(256)) * 3
-        else:
-            palette = []
-            for r, g, b in self.clut:
-                palette.extend([r, g, b])
-            while len(palette) < 768:
-                palette.extend([0, 0, 0])
-        
-        # pPainter reads in words (16-bit chunks) and extracts 2 pixels per word
-        px_width = width
+        palette = self._build_palette(256)
+
+        # pPainter reads in words (16-bit chunks) and extracts 2 pixels per word,
+        # low byte first - which is simply the byte order of the scanline
         w16 = (width + 1) // 2  # Number of 16-bit words needed per scanline
-        
-        pixel_indices = []
-        offset = 0
-        
-        for y in range(height):
-            for x in range(w16):
-                if offset + 1 < len(raw_data):
-                    word = struct.unpack("<H", raw_data[offset:offset+2])[0]
-                else:
-                    word = 0
-                offset += 2
-                
-                # Extract 2 pixels from this word
-                lo = word & 0xFF
-                hi = (word >> 8) & 0xFF
-                pixel_indices.append(lo)
-                pixel_indices.append(hi)
-        
-        # Trim to exact dimensions
-        pixel_indices = pixel_indices[:width * height]
-        
-        img = Image.new("P", (width, height))
+        data = self._word_buffer(raw_data, w16 * 2 * height)
+
+        img = Image.frombytes("P", (width, height), data, "raw", "P", w16 * 2, 1)
         img.putpalette(palette)
-        img.putdata(pixel_indices)
         return img
 
     def _decode_4bit(self, raw_data, width, height):
         """Decode 4-bit paletted color - matching pPainter algorithm exactly"""
-        # Create palette
-        if not self.clut:
-            palette = list(range(16)) * 3
-        else:
-            palette = []
-            for r, g, b in self.clut:
-                palette.extend([r, g, b])
-            while len(palette) < 48:
-                palette.extend([0, 0, 0])
-        
+        palette = self._build_palette(16)
+
         # pPainter reads in words (16-bit chunks) and extracts 4 pixels per word
-        # Each pixel is 4 bits, so: pixels[0:4] come from shifts 0,4,8,12
-        px_width = width
+        # Each pixel is 4 bits, so: pixels[0:4] come from shifts 0,4,8,12.
+        # PIL's P;4 unpacker takes the high nibble first, so swap nibbles.
         w16 = (width + 3) // 4  # Number of 16-bit words needed per scanline
-        
-        pixel_indices = []
-        offset = 0
-        
-        for y in range(height):
-            for x in range(w16):
-                if offset + 1 < len(raw_data):
-                    word = struct.unpack("<H", raw_data[offset:offset+2])[0]
-                else:
-                    word = 0
-                offset += 2
-                
-                # Extract 4 pixels from this word (shifts 0, 4, 8, 12)
-                for i in range(4):
-                    idx = (word >> (4 * i)) & 0x0F
-                    pixel_indices.append(idx)
-        
-        # Trim to exact dimensions
-        pixel_indices = pixel_indices[:width * height]
-        
-        img = Image.new("P", (width, height))
+        data = self._word_buffer(raw_data, w16 * 2 * height)
+
+        img = Image.frombytes("P", (width, height), data.translate(_NIBBLE_SWAP),
+                              "raw", "P;4", w16 * 2, 1)
         img.putpalette(palette)
-        img.putdata(pixel_indices)
         return img
 
     def encode(self):
-        """Encode the image back to raw pixel data"""
+        """Encode the image back to raw pixel data
+
+        When the original pixel words are known for the current size and
+        BPP they are reused, and only regions whose pixels changed are
+        re-encoded, so untouched pixels (STP bits included) stay bit-exact.
+        """
         if self.image is None:
             raise ValueError("No image to encode")
         
+        # Paletted indices re-encode losslessly, and faster than any diff
+        rects = None
+        if self.bpp == 16 or self.image.mode != "P":
+            rects, source = self._changes()
+        if rects is None:
+            return self._encode_image(self.image)
+
+        raw = bytearray(self.raw_pixels)
+        for rect in rects:
+            self._patch_rect(rect, [(raw, 0)], source)
+        return bytes(raw)
+
+    def changed_rects(self, band_height=16):
+        """Rectangles (x0, y0, x1, y1) of pixels that differ from raw_pixels
+
+        The image is compared with a decode of the original words one band
+        of scanlines at a time, giving one bounding box per changed band.
+        Returns None when there is nothing to compare against: no original
+        words, a different size or BPP, or a non-paletted image for a 4/8bpp
+        TIM without a CLUT (quantizing a region would invent its own palette).
+        """
+        return self._changes(band_height)[0]
+
+    def _changes(self, band_height=16):
+        """(changed_rects(), image to encode those rects from)
+
+        For a non-paletted image on a 4/8bpp TIM the source holds the
+        original indices wherever the color is unchanged, so pixels whose
+        color several CLUT entries share keep the entry they had.
+        """
+        img = self.image
+        if self.raw_pixels is None or self._raw_geometry != (self.bpp, img.width, img.height):
+            return None, None
+        if self.bpp != 16 and img.mode != "P" and not self.clut:
+            return None, None
+
+        if self._raw_image is None:
+            self._raw_image = self._decode_pixels(self.raw_pixels, img.width, img.height, self.bpp)
+        original = self._raw_image
+        source = img
+        if img.mode == "P" and original.mode == "P":
+            # Compare indices, not the colors the palettes give them
+            diff = ImageChops.difference(Image.frombytes("L", img.size, img.tobytes()),
+                                         Image.frombytes("L", img.size, original.tobytes()))
+        else:
+            # Colors that only differ below 5-bit precision encode the same.
+            # Both sides go through 5551 so CLUT colors (stored as v << 3)
+            # compare equal to their bit-replicated decode.
+            if original.mode == "P":
+                original = _through_5551(original)
+            diff = ImageChops.difference(_through_5551(img), original)
+            if self._raw_image.mode == "P":
+                r, g, b = diff.split()
+                mask = ImageChops.lighter(ImageChops.lighter(r, g), b).point(lambda v: 255 if v else 0)
+                source = self._raw_image.copy()
+                source.paste(self._remap_to_clut(img, 16 if self.bpp == 4 else 256), mask=mask)
+
+        bbox = diff.getbbox()
+        if bbox is None:
+            return [], source
+        x0, top, x1, bottom = bbox
+        rects = []
+        for y in range(top, bottom, band_height):
+            box = diff.crop((x0, y, x1, min(y + band_height, bottom))).getbbox()
+            if box:
+                rects.append((x0 + box[0], y + box[1], x0 + box[2], y + box[3]))
+        return rects, source
+
+    def _patch_rect(self, rect, targets, source):
+        """Re-encode one rectangle of source and write its words into pixel buffers
+
+        targets is a list of (buffer, offset of the pixel data in it). The
+        rectangle is widened to whole 16-bit words first.
+        """
+        x0, y0, x1, y1 = rect
+        per_word = 16 // self.bpp
+        x0 = x0 // per_word * per_word
+        x1 = -(-x1 // per_word) * per_word
+
+        data = self._encode_image(source.crop((x0, y0, x1, y1)))
+        line_size = (self.image.width * self.bpp + 15) // 16 * 2
+        span = (x1 - x0) // per_word * 2
+        start = y0 * line_size + x0 // per_word * 2
+
+        for buf, base in targets:
+            offset = base + start
+            for row in range(y1 - y0):
+                buf[offset:offset + span] = data[row * span:(row + 1) * span]
+                offset += line_size
+
+    def _encode_image(self, img):
+        """Encode a whole image at this TIM's BPP"""
         if self.bpp == 16:
-            return self._encode_16bit()
+            return self._encode_16bit(img)
         elif self.bpp == 8:
-            return self._encode_8bit()
+            return self._encode_8bit(img)
         elif self.bpp == 4:
-            return self._encode_4bit()
+            return self._encode_4bit(img)
         else:
             raise ValueError(f"Unsupported BPP: {self.bpp}")
 
-    def _encode_16bit(self):
+    def _encode_16bit(self, img):
         """Encode to 16-bit direct color"""
-        raw = bytearray()
-        
-        if self.image.mode != "RGB":
-            img = self.image.convert("RGB")
-        else:
-            img = self.image
-        
-        for pixel in img.getdata():
-            r, g, b = pixel
-            color_word = self._encode5551(r, g, b)
-            raw.extend(struct.pack("<H", color_word))
-        
-        return bytes(raw)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        return _encode_words(img)
 
-    def _encode_8bit(self):
+    def _encode_8bit(self, img):
         """Encode to 8-bit paletted color"""
-        raw = bytearray()
-        
-        if self.image.mode == "P":
-            raw.extend(self.image.tobytes())
+        # Non-paletted images are mapped onto the CLUT they will be saved
+        # with; only without one is a palette generated by quantizing
+        if img.mode == "P":
+            pass
+        elif self.clut:
+            img = self._remap_to_clut(img, 256)
         else:
-            img = self.image.quantize(colors=256)
-            raw.extend(img.tobytes())
-        
-        return bytes(raw)
+            img = img.quantize(colors=256)
+
+        # Scanlines are padded to a whole number of 16-bit words
+        w16 = (img.width + 1) // 2
+        return img.tobytes("raw", "P", w16 * 2, 1)
 
-    def _encode_4bit(self):
+    def _encode_4bit(self, img):
         """Encode to 4-bit paletted color"""
-        raw = bytearray()
-        
-        if self.image.mode == "P":
-            pixel_data = list(self.image.getdata())
+        if img.mode == "P":
+            pass
+        elif self.clut:
+            img = self._remap_to_clut(img, 16)
         else:
-            img = self.image.quantize(colors=16)
-            pixel_data = list(img.getdata())
-        
-        for i in range(0, len(pixel_data), 2):
-            low = pixel_data[i] & 0x0F
-            high = (pixel_data[i+1] & 0x0F) if i+1 < len(pixel_data) else 0
-            byte_val = low | (high << 4)
-            raw.append(byte_val)
-        
-        return bytes(raw)
+            img = img.quantize(colors=16)
+
+        # PIL packs two indices per byte high nibble first (keeping only the
+        # low 4 bits of each); TIM wants the leftmost pixel in the low nibble.
+        # Scanlines are padded to a whole number of 16-bit words.
+        w16 = (img.width + 3) // 4
+        return img.tobytes("raw", "P;4", w16 * 2, 1).translate(_NIBBLE_SWAP)
+
+    def clut_words(self):
+        """The CLUTs as (colors per row, 5551 words), as stored in the file and VRAM
+
+        One row per palette, short palettes padded with black. Entries whose
+        color still matches raw_clut keep its word, STP bit included.
+        """
+        num_colors = max(len(palette) for palette in self.cluts)
+        words = []
+        for palette in self.cluts:
+            words.extend(self._encode5551(r, g, b) for r, g, b in palette)
+            words.extend([0] * (num_colors - len(palette)))
+        raw = self.raw_clut
+        if raw is not None and len(raw) == len(words):
+            words = [old if old & 0x7FFF == word else word for old, word in zip(raw, words)]
+        return num_colors, words
+
+    def _clut_block_size(self):
+        """Size in bytes of the CLUT block build_into writes (0 without one)"""
+        if not (self.has_clut and self.clut):
+            return 0
+        num_colors = max(len(palette) for palette in self.cluts)
+        return 12 + num_colors * len(self.cluts) * 2
+
+    def file_size(self):
+        """Exact size in bytes of the file build_file/build_into produce"""
+        pixel_size = self._scanline_words() * 2 * self.height
+        return 8 + self._clut_block_size() + 12 + pixel_size
+
+    def build_into(self, buf, offset=0):
+        """Write the complete TIM file into buf at offset
+
+        buf is any writable buffer (bytearray, memoryview, mmap) with at
+        least file_size() bytes free from offset, so TIMs can be embedded
+        straight into larger archives. Returns the number of bytes written.
+        """
+        size = self.file_size()
+        if len(buf) - offset < size:
+            raise ValueError(f"Buffer too small for TIM ({size} bytes needed)")
+
+        pixel_data = self.encode()
+        pixel_size = self._scanline_words() * 2 * self.height
+        if len(pixel_data) != pixel_size:
+            raise ValueError("Image size does not match the TIM width/height")
+
+        pos = self._build_headers_into(buf, offset)
+        buf[pos:pos + pixel_size] = pixel_data
+
+        return size
+
+    def _build_headers_into(self, buf, offset):
+        """Write the file header, CLUT block and image block header
+
+        Returns the offset in buf where the pixel data starts.
+        """
+        pixel_size = self._scanline_words() * 2 * self.height
 
-    def build_file(self):
-        """Build complete TIM file data"""
-        file_data = bytearray()
-        
-        file_data.extend(struct.pack("<I", 0x00000010))
-        
         flags = 0
         if self.has_clut:
             flags |= 0x08
         flags |= (self.bpp == 4 and 0) or (self.bpp == 8 and 1) or (self.bpp == 16 and 2)
-        file_data.extend(struct.pack("<I", flags))
-        
-        if self.has_clut and self.clut:
-            clut_data = bytearray()
-            num_colors = len(self.clut)
-            clut_size = 12 + num_colors * 2
-            clut_data.extend(struct.pack("<I", clut_size))
-            clut_data.extend(struct.pack("<HHHH", 0, 0, num_colors, 1))
-            
-            for r, g, b in self.clut:
-                color_word = self._encode5551(r, g, b)
-                clut_data.extend(struct.pack("<H", color_word))
-            
-            file_data.extend(clut_data)
-        
-        pixel_data = self.encode()
-        img_block = bytearray()
-        img_block_size = 12 + len(pixel_data)
-        img_block.extend(struct.pack("<I", img_block_size))
-        img_block.extend(struct.pack("<HHHH", 0, 0, self.width, self.height))
-        img_block.extend(pixel_data)
-        
-        file_data.extend(img_block)
-        
+        struct.pack_into("<II", buf, offset, 0x00000010, flags)
+        pos = offset + 8
+
+        clut_size = self._clut_block_size()
+        if clut_size:
+            num_colors, words = self.clut_words()
+            struct.pack_into("<I4H", buf, pos, clut_size,
+                             self.clut_x, self.clut_y, num_colors, len(self.cluts))
+            struct.pack_into(f"<{len(words)}H", buf, pos + 12, *words)
+            pos += clut_size
+
+        struct.pack_into("<I4H", buf, pos, 12 + pixel_size,
+                         self.x, self.y, self._scanline_words(), self.height)
+        return pos + 12
+
+    def build_file(self):
+        """Build complete TIM file data"""
+        file_data = bytearray(self.file_size())
+        self.build_into(file_data)
         return bytes(file_data)
 
     def save(self, path):
-        """Save image as TIM file"""
+        """Save image as TIM file
+
+        Saving back over the loaded file with the same size, BPP and CLUT
+        layout patches only the changed pixel rows in place. Otherwise the
+        file is encoded straight into a memory map of a temporary file next
+        to path, which then replaces path, so a failed save never leaves a
+        truncated TIM behind.
+        """
         if self.image is None:
             raise ValueError("No image to save")
         
         self.width = self.image.width
         self.height = self.image.height
         
-        data = self.build_file()
-        with open(path, "wb") as f:
-            f.write(data)
+        if self._save_in_place(path):
+            return
+
+        size = self.file_size()
+        pixel_start = size - self._scanline_words() * 2 * self.height
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w+b") as f:
+                f.truncate(size)
+                with mmap.mmap(f.fileno(), size) as data:
+                    self.build_into(data)
+                    self._set_raw_pixels(data[pixel_start:size])
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
         
         self.file_path = path
+        self._pixel_range = (pixel_start, size)
+        self.raw_clut = self.clut_words()[1] if self._clut_block_size() else None
+
+    def _save_in_place(self, path):
+        """Patch changed rows into the loaded file; False if its layout differs"""
+        if self.file_path is None or self._pixel_range is None:
+            return False
+        try:
+            if not os.path.samefile(path, self.file_path):
+                return False
+        except OSError:
+            # Either file is missing, e.g. the loaded one was moved or deleted
+            return False
+
+        rects, source = self._changes()
+        if rects is None:
+            return False
+
+        size = self.file_size()
+        pixel_start = size - self._scanline_words() * 2 * self.height
+        if self._pixel_range != (pixel_start, size) or os.path.getsize(path) != size:
+            return False
+
+        # Headers and CLUT are tiny; rewrite them only if the palettes or
+        # VRAM placement changed
+        headers = bytearray(pixel_start)
+        self._build_headers_into(headers, 0)
+        with open(path, "r+b") as f:
+            with mmap.mmap(f.fileno(), size) as data:
+                if data[:pixel_start] != headers:
+                    data[:pixel_start] = headers
+                for rect in rects:
+                    self._patch_rect(rect, [(data, pixel_start), (self.raw_pixels, 0)], source)
+        if self._clut_block_size():
+            self.raw_clut = self.clut_words()[1]
+        if rects:
+            self._raw_image = None
+        return True
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _tim_from_data(cls, path, data=None):
+    """Build a TIM from file contents (read here if not given)
+
+    Module level so it can run in a worker process.
+    """
+    tim = cls()
+    tim.file_path = path
+    tim._load_data(_read_file(path) if data is None else data)
+    return tim
+
+
+async def load_many(paths, concurrency=16, executor=None, return_exceptions=False):
+    """Load many TIM files concurrently, returning TimImages in path order
+
+    At most concurrency files are being read or decoded at any time, so
+    thousands of paths do not mean thousands of open files or decoded
+    images waiting in executor queues. With return_exceptions=True a failed
+    load puts its exception in the result list; otherwise the first failure
+    cancels the remaining loads and is raised. Cancelling the caller
+    cancels every pending load.
+    """
+    if concurrency < 1:
+        raise ValueError("Concurrency must be at least 1")
+
+    paths = list(paths)
+    results = [None] * len(paths)
+    # Shared by all workers, so each index is handed out exactly once
+    indices = iter(range(len(paths)))
+
+    async def worker():
+        for i in indices:
+            try:
+                results[i] = await TimImage.load_async(paths[i], executor)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results[i] = e
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(concurrency, len(paths)))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        # Let cancelled workers unwind before returning or re-raising
+        await asyncio.gather(*workers, return_exceptions=True)
+    return results
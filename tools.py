@@ -1,69 +1,129 @@
 from PIL import Image, ImageDraw
 import math
 
+from tiles import TiledImage
+
 class DrawingTools:
     """Collection of drawing tools for the image editor"""
     
-    def __init__(self, image):
-        # Convert to RGBA if needed for drawing
-        if image.mode != 'RGBA':
-            self.image = image.convert('RGBA')
-        else:
+    def __init__(self, image, transparent_index=0, before_draw=None):
+        # Called with each box just before its pixels are drawn on, so undo
+        # history can save them (see UndoRedoManager.touch)
+        self.before_draw = before_draw
+        # Tiled layers are drawn a region at a time, see _shape()
+        self.tiled = image if isinstance(image, TiledImage) else None
+        self.draw = None
+        # What the eraser writes
+        self.erase_color = (0, 0, 0, 0)
+        if self.tiled is not None:
+            self.image = image
+        elif image.mode == 'P':
+            # Indexed layers are drawn in place with palette indices as colors
             self.image = image
-        self.draw = ImageDraw.Draw(self.image, 'RGBA')
+            self.draw = ImageDraw.Draw(self.image)
+            self.erase_color = transparent_index
+        else:
+            # Convert to RGBA if needed for drawing
+            if image.mode != 'RGBA':
+                self.image = image.convert('RGBA')
+            else:
+                self.image = image
+            self.draw = ImageDraw.Draw(self.image, 'RGBA')
+        # Bounding box (x0, y0, x1, y1) of every pixel drawn so far, or None
+        self.dirty = None
+    
+    def _damage(self, box):
+        """Grow the dirty box to cover box"""
+        if self.dirty is not None:
+            box = (min(box[0], self.dirty[0]), min(box[1], self.dirty[1]),
+                   max(box[2], self.dirty[2]), max(box[3], self.dirty[3]))
+        self.dirty = box
+    
+    def _shape(self, shape, xy, pad=0, **kwargs):
+        """Draw an ImageDraw shape given by two corner points and mark it dirty
+        
+        pad widens the bounds for line widths. On a tiled image only the
+        covered region is built from tiles, drawn on and written back.
+        """
+        (x0, y0), (x1, y1) = xy
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        box = (max(int(x0) - pad, 0), max(int(y0) - pad, 0),
+               min(int(x1) + pad + 2, self.image.width), min(int(y1) + pad + 2, self.image.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        if self.before_draw is not None:
+            self.before_draw(box)
+        
+        if self.tiled is None:
+            getattr(self.draw, shape)(xy, **kwargs)
+        else:
+            region = self.tiled.crop(box)
+            draw = ImageDraw.Draw(region, 'RGBA')
+            getattr(draw, shape)([(x - box[0], y - box[1]) for x, y in xy], **kwargs)
+            self.tiled.paste(region, box[:2])
+        self._damage(box)
     
     def pencil(self, x0, y0, x1, y1, color, size=1):
         """Draw a line using pencil tool"""
-        self.draw.line([(x0, y0), (x1, y1)], fill=color, width=size)
+        self._shape("line", [(x0, y0), (x1, y1)], size // 2 + 1, fill=color, width=size)
     
     def brush(self, x, y, color, size=5):
         """Draw a filled circle (brush stroke)"""
         radius = size // 2
-        self.draw.ellipse(
-            [(x - radius, y - radius), (x + radius, y + radius)],
-            fill=color
-        )
+        self._shape("ellipse", [(x - radius, y - radius), (x + radius, y + radius)], fill=color)
     
     def eraser(self, x, y, size=5):
         """Erase by drawing transparent circles"""
         radius = size // 2
-        self.draw.ellipse(
-            [(x - radius, y - radius), (x + radius, y + radius)],
-            fill=(0, 0, 0, 0)
-        )
+        self._shape("ellipse", [(x - radius, y - radius), (x + radius, y + radius)],
+                    fill=self.erase_color)
     
     def rectangle(self, x0, y0, x1, y1, color, filled=False, width=1):
         """Draw a rectangle"""
         if filled:
-            self.draw.rectangle([(x0, y0), (x1, y1)], fill=color)
+            self._shape("rectangle", [(x0, y0), (x1, y1)], fill=color)
         else:
-            self.draw.rectangle([(x0, y0), (x1, y1)], outline=color, width=width)
+            self._shape("rectangle", [(x0, y0), (x1, y1)], outline=color, width=width)
     
     def ellipse(self, x0, y0, x1, y1, color, filled=False, width=1):
         """Draw an ellipse"""
         if filled:
-            self.draw.ellipse([(x0, y0), (x1, y1)], fill=color)
+            self._shape("ellipse", [(x0, y0), (x1, y1)], fill=color)
         else:
-            self.draw.ellipse([(x0, y0), (x1, y1)], outline=color, width=width)
+            self._shape("ellipse", [(x0, y0), (x1, y1)], outline=color, width=width)
     
     def line(self, x0, y0, x1, y1, color, width=1):
         """Draw a straight line"""
-        self.draw.line([(x0, y0), (x1, y1)], fill=color, width=width)
+        self._shape("line", [(x0, y0), (x1, y1)], width // 2 + 1, fill=color, width=width)
     
     def bucket_fill(self, x, y, color, threshold=10):
         """Flood fill from a point"""
-        # Convert image to RGBA if needed
-        if self.image.mode != 'RGBA':
-            self.image = self.image.convert('RGBA')
+        # A fill can reach anywhere, so a tiled image is filled whole
+        image = self.image if self.tiled is None else self.tiled.to_image()
+        
+        # Convert image to RGBA if needed; indices are compared exactly
+        if image.mode == 'P':
+            threshold = 0
+        elif image.mode != 'RGBA':
+            image = image.convert('RGBA')
         
         # Get the target color
         try:
-            target = self.image.getpixel((int(x), int(y)))
+            target = image.getpixel((int(x), int(y)))
         except:
             return
         
         # Perform flood fill
-        ImageDraw.floodfill(self.image, (int(x), int(y)), color, thresh=threshold)
+        if self.before_draw is not None:
+            self.before_draw((0, 0, image.width, image.height))
+        ImageDraw.floodfill(image, (int(x), int(y)), color, thresh=threshold)
+        if self.tiled is not None:
+            self.tiled.paste(image, (0, 0))
+        else:
+            self.image = image
+        # The filled area is unknown, so the whole image is dirty
+        self._damage((0, 0, image.width, image.height))
 
 
 class ImageAdjustments:
@@ -1,56 +1,335 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-import copy
+import os
+import tempfile
+import zlib
+
+
+def _compress(images, level):
+    # Runs on the background thread; zlib releases the GIL while it works
+    return [zlib.compress(image.tobytes(), level) for image in images]
+
+
+class _Segment:
+    """One spill file, written append-only; removed once none of its entries are left"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w+b")
+        self.size = 0
+        self.live = 0
+
+    def write(self, data):
+        """Append data, returning its offset"""
+        offset = self.size
+        self.file.seek(offset)
+        self.file.write(data)
+        self.size += len(data)
+        self.live += 1
+        return offset
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def close(self):
+        self.file.close()
+        os.remove(self.path)
+
+
+class _Pixels:
+    """The pixels of one history entry
+
+    They start as an image, are replaced by zlib-compressed bytes once
+    compressed in the background, and may then be moved to a spill file.
+    load() gives an image back whichever form they are in.
+    """
+
+    def __init__(self, image):
+        self.mode = image.mode
+        self.size = image.size
+        self.palette = image.getpalette() if image.mode == "P" else None
+        self.nbytes = image.width * image.height * len(image.getbands())
+        self.image = image
+        self.blob = None
+        # Spill file, offset and length once moved to disk
+        self.segment = None
+        self.offset = 0
+        self.disk_bytes = 0
+        self.dropped = False
+
+    def load(self):
+        if self.image is not None:
+            return self.image
+        data = self.blob
+        if data is None:
+            data = self.segment.read(self.offset, self.disk_bytes)
+        image = Image.frombytes(self.mode, self.size, zlib.decompress(data))
+        if self.palette is not None:
+            image.putpalette(self.palette)
+        return image
+
 
 class UndoRedoManager:
-    """Manages undo and redo states"""
-    
-    def __init__(self, max_history=50):
-        self.history = []
+    """Manages undo and redo of layer edits
+
+    Each history entry holds only the rectangle a stroke changed on one
+    layer, so memory follows the size of the edits rather than the canvas.
+    A stroke is recorded in three steps: begin_stroke(layer) before the
+    first change, touch(box) just before each region is drawn, and
+    end_stroke() once the stroke is done. Only the touched regions are
+    copied, so starting a stroke costs nothing whatever the canvas size.
+    undo() and redo() write the pixels back into the layer itself.
+
+    History is a ring buffer. Entries stay uncompressed until history takes
+    more than max_memory bytes of RAM. Then all but the raw_entries most
+    recently used entries are compressed in one batch on a background
+    thread, and the oldest compressed entries are moved to spill files in a
+    temporary directory (under spill_dir if given) until RAM use is back
+    under half of max_memory. Strokes below that threshold never touch the
+    thread or the disk. Compressed history, in RAM and on disk, is bounded
+    by max_bytes; the oldest entries are dropped first. Undoing into an
+    older entry decompresses it on demand.
+    """
+
+    # Spill files roll over at this size so dropped history frees disk space
+    SEGMENT_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, max_memory=32 * 1024 * 1024,
+                 raw_entries=4, spill_dir=None, level=1):
+        # (layer, box, _Pixels) entries; the first current ones can be undone,
+        # the rest redone
+        self.history = deque()
         self.current_state = 0
-        self.max_history = max_history
-    
-    def save_state(self, image):
-        """Save the current state to history"""
-        # Remove any redo history after current state
-        self.history = self.history[:self.current_state + 1]
-        
-        # Save a copy of the image
-        if isinstance(image, Image.Image):
-            state = image.copy()
-        else:
-            state = copy.deepcopy(image)
-        
-        self.history.append(state)
+        self.max_bytes = max_bytes
+        self.max_memory = max_memory
+        self.raw_entries = raw_entries
+        self.spill_dir = spill_dir
+        self.level = level
+        self._raw_bytes = 0
+        self._blob_bytes = 0
+        self._disk = 0
+        # Pixels in the order they became raw, were sent for compression (as
+        # (future, batch) pairs) and were compressed; entries dropped
+        # meanwhile are skipped
+        self._raw = deque()
+        self._pending = deque()
+        self._compressed = deque()
+        self._executor = None
+        self._spill = None
+        self._segments = []
+        self._segment_count = 0
+        # Layer, (box, pixels) copied from it before each touch, and the
+        # box bounding them all
+        self._stroke = None
+
+    def begin_stroke(self, layer):
+        """Start recording edits to a layer"""
+        self.end_stroke()
+        self._stroke = [layer, [], None]
+
+    def touch(self, box):
+        """Remember a region's pixels before the stroke in progress draws on it"""
+        if self._stroke is None or box is None:
+            return
+        layer, saved, old = self._stroke
+        image = layer.image
+        box = (max(box[0], 0), max(box[1], 0), min(box[2], image.width), min(box[3], image.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        if saved:
+            last = saved[-1][0]
+            if last[0] <= box[0] and last[1] <= box[1] and box[2] <= last[2] and box[3] <= last[3]:
+                # Already saved, e.g. a brush dabbing in place
+                return
+        saved.append((box, image.crop(box)))
+        if old is not None:
+            box = (min(old[0], box[0]), min(old[1], box[1]), max(old[2], box[2]), max(old[3], box[3]))
+        self._stroke[2] = box
+
+    def end_stroke(self):
+        """Record the stroke in progress, if it changed anything"""
+        if self._stroke is None:
+            return
+        layer, saved, box = self._stroke
+        self._stroke = None
+        if box is None:
+            return
+
+        # Regions saved later may already hold the stroke's pixels where they
+        # overlap earlier ones, so the earliest copy of each pixel goes last
+        before = layer.image.crop(box)
+        for (x0, y0, _, _), pixels in reversed(saved):
+            before.paste(pixels, (x0 - box[0], y0 - box[1]))
+        self._push(layer, box, before)
+
+    def _push(self, layer, box, image):
+        # A new edit replaces anything that could have been redone
+        while len(self.history) > self.current_state:
+            self._release(self.history.pop()[2])
+
+        pixels = self._track(image)
+        if pixels.nbytes > self.max_bytes:
+            # Older entries cannot be undone past an edit that was not kept
+            self.clear()
+            return
+
+        self.history.append((layer, box, pixels))
         self.current_state += 1
-        
-        # Limit history size
-        if len(self.history) > self.max_history:
-            self.history.pop(0)
+        self._maintain()
+
+    def _track(self, image):
+        """Wrap an image as the pixels of a new or swapped entry"""
+        pixels = _Pixels(image)
+        self._raw_bytes += pixels.nbytes
+        self._raw.append(pixels)
+        return pixels
+
+    def _release(self, pixels):
+        """Forget an entry's pixels, wherever they are kept"""
+        pixels.dropped = True
+        if pixels.image is not None:
+            self._raw_bytes -= pixels.nbytes
+        elif pixels.blob is not None:
+            self._blob_bytes -= len(pixels.blob)
+        elif pixels.segment is not None:
+            self._disk -= pixels.disk_bytes
+            segment = pixels.segment
+            segment.live -= 1
+            if segment.live == 0 and segment is not self._segments[-1]:
+                segment.close()
+                self._segments.remove(segment)
+        pixels.image = pixels.blob = pixels.segment = None
+
+    def _maintain(self):
+        """Compress, drop and spill entries to keep within the budgets"""
+        # Take in what the background thread has finished
+        while self._pending and self._pending[0][0].done():
+            future, batch = self._pending.popleft()
+            for pixels, blob in zip(batch, future.result()):
+                if pixels.dropped:
+                    continue
+                self._raw_bytes -= pixels.nbytes
+                pixels.blob = blob
+                pixels.image = None
+                self._blob_bytes += len(blob)
+                self._compressed.append(pixels)
+
+        # Work is handed to the background thread only under memory
+        # pressure, and one batch at a time, so ordinary strokes pay nothing
+        # for it; the batch takes every older raw entry, which leaves plenty
+        # of room before the next one
+        over = self.memory_bytes() > self.max_memory
+        if over and not self._pending and len(self._raw) > self.raw_entries:
+            batch = []
+            while len(self._raw) > self.raw_entries:
+                pixels = self._raw.popleft()
+                if not pixels.dropped:
+                    batch.append(pixels)
+            if batch:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1)
+                future = self._executor.submit(_compress, [pixels.image for pixels in batch], self.level)
+                self._pending.append((future, batch))
+
+        while self._blob_bytes + self._disk > self.max_bytes and self.current_state > 0:
+            self._release(self.history.popleft()[2])
             self.current_state -= 1
-    
+
+        if over:
+            while self.memory_bytes() > self.max_memory // 2 and self._compressed:
+                pixels = self._compressed.popleft()
+                if pixels.dropped or pixels.blob is None:
+                    continue
+                self._spill_pixels(pixels)
+
+    def _spill_pixels(self, pixels):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryDirectory(prefix="timedit-undo-", dir=self.spill_dir)
+        if not self._segments or self._segments[-1].size >= self.SEGMENT_BYTES:
+            if self._segments and self._segments[-1].live == 0:
+                self._segments.pop().close()
+            self._segment_count += 1
+            self._segments.append(_Segment(os.path.join(self._spill.name, f"{self._segment_count}.undo")))
+        segment = self._segments[-1]
+        pixels.offset = segment.write(pixels.blob)
+        pixels.segment = segment
+        pixels.disk_bytes = len(pixels.blob)
+        self._blob_bytes -= pixels.disk_bytes
+        self._disk += pixels.disk_bytes
+        pixels.blob = None
+
+    def _swap(self, entry):
+        """Write an entry's pixels into its layer; return the entry to reverse that"""
+        layer, box, pixels = entry
+        image = layer.image
+        replaced = image.crop(box)
+        image.paste(pixels.load(), box[:2])
+        layer.mark_dirty()
+        self._release(pixels)
+        return layer, box, self._track(replaced)
+
     def undo(self):
-        """Get the previous state"""
+        """Undo the last edit, returning the box that changed (or None)"""
+        self.end_stroke()
         if self.current_state > 0:
             self.current_state -= 1
-            return self.history[self.current_state].copy()
+            entry = self.history[self.current_state]
+            self.history[self.current_state] = self._swap(entry)
+            self._maintain()
+            return entry[1]
         return None
-    
+
     def redo(self):
-        """Get the next state"""
-        if self.current_state < len(self.history) - 1:
+        """Redo the last undone edit, returning the box that changed (or None)"""
+        if self.current_state < len(self.history):
+            entry = self.history[self.current_state]
+            self.history[self.current_state] = self._swap(entry)
             self.current_state += 1
-            return self.history[self.current_state].copy()
+            self._maintain()
+            return entry[1]
         return None
-    
+
     def can_undo(self):
         """Check if undo is available"""
-        return self.current_state > 0
-    
+        return self.current_state > 0 or self._stroke is not None and self._stroke[2] is not None
+
     def can_redo(self):
         """Check if redo is available"""
-        return self.current_state < len(self.history) - 1
-    
+        return self.current_state < len(self.history)
+
+    def memory_bytes(self):
+        """Bytes of history held in RAM, raw or compressed"""
+        return self._raw_bytes + self._blob_bytes
+
+    def disk_bytes(self):
+        """Bytes of history spilled to disk"""
+        return self._disk
+
     def clear(self):
         """Clear all history"""
-        self.history = []
+        for future, _ in self._pending:
+            future.cancel()
+        self.history = deque()
         self.current_state = 0
+        self._raw_bytes = 0
+        self._blob_bytes = 0
+        self._disk = 0
+        self._raw = deque()
+        self._pending = deque()
+        self._compressed = deque()
+        self._stroke = None
+        for segment in self._segments:
+            segment.file.close()
+        self._segments = []
+        if self._spill is not None:
+            self._spill.cleanup()
+            self._spill = None
+
+    def close(self):
+        """Clear history and stop the background thread"""
+        self.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
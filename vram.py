@@ -0,0 +1,141 @@
+from PIL import Image
+import struct
+
+from timedit import TimImage
+
+VRAM_WIDTH = 1024
+VRAM_HEIGHT = 512
+
+
+def _intersect(a, b):
+    """Intersection of two (x0, y0, x1, y1) rectangles, or None"""
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (x0, y0, x1, y1)
+
+
+def _union(a, b):
+    """Bounding box of two rectangles"""
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+class Vram:
+    """The PS1's 1024x512 16-bit VRAM with TIMs placed at their own x/y
+
+    TIMs are composited in the order they were added, later ones on top.
+    The framebuffer holds raw 16-bit words, so paletted textures show up
+    the way the GPU sees them (packed indices) and CLUTs appear as short
+    rows of colors. Changes are tracked as dirty rectangles; recomposite()
+    rebuilds and re-renders only those.
+    """
+
+    def __init__(self):
+        self.tims = []
+        self.words = bytearray(VRAM_WIDTH * VRAM_HEIGHT * 2)
+        self.image = Image.new("RGB", (VRAM_WIDTH, VRAM_HEIGHT))
+        self.dirty = []
+        # id(tim) -> list of (rect, raw words) blocks it occupies
+        self._blocks = {}
+
+    def _build_blocks(self, tim):
+        """Encode a TIM's image and CLUT into VRAM blocks"""
+        w16 = (tim.width * tim.bpp + 15) // 16
+        blocks = [((tim.x, tim.y, tim.x + w16, tim.y + tim.height), tim.encode())]
+
+        if tim.has_clut and tim.clut:
+            num_colors, words = tim.clut_words()
+            rect = (tim.clut_x, tim.clut_y,
+                    tim.clut_x + num_colors, tim.clut_y + len(tim.cluts))
+            blocks.append((rect, struct.pack(f"<{len(words)}H", *words)))
+
+        return blocks
+
+    def add(self, tim):
+        """Place a TIM at its VRAM coordinates"""
+        self.tims.append(tim)
+        self._blocks[id(tim)] = self._build_blocks(tim)
+        self._mark_blocks(tim)
+
+    def remove(self, tim):
+        """Take a TIM out of VRAM, exposing whatever lies beneath it"""
+        self._mark_blocks(tim)
+        self.tims.remove(tim)
+        del self._blocks[id(tim)]
+
+    def update(self, tim):
+        """Re-encode a TIM after its pixels, CLUT or position changed"""
+        # Both the old and the new footprint need recompositing
+        self._mark_blocks(tim)
+        self._blocks[id(tim)] = self._build_blocks(tim)
+        self._mark_blocks(tim)
+
+    def _mark_blocks(self, tim):
+        for rect, _ in self._blocks[id(tim)]:
+            self.mark_dirty(rect)
+
+    def mark_dirty(self, rect):
+        """Queue a rectangle for recompositing, merging overlapping ones"""
+        rect = _intersect(rect, (0, 0, VRAM_WIDTH, VRAM_HEIGHT))
+        if rect is None:
+            return
+
+        merged = True
+        while merged:
+            merged = False
+            for i, other in enumerate(self.dirty):
+                if _intersect(rect, other):
+                    rect = _union(rect, self.dirty.pop(i))
+                    merged = True
+                    break
+        self.dirty.append(rect)
+
+    def recomposite(self):
+        """Rebuild and re-render the dirty regions
+
+        Returns the list of rectangles that were updated in self.image.
+        """
+        updated = self.dirty
+        self.dirty = []
+
+        for rect in updated:
+            self._clear(rect)
+            for tim in self.tims:
+                for block_rect, data in self._blocks[id(tim)]:
+                    overlap = _intersect(rect, block_rect)
+                    if overlap:
+                        self._blit(overlap, block_rect, data)
+            self._render(rect)
+
+        return updated
+
+    def _clear(self, rect):
+        x0, y0, x1, y1 = rect
+        blank = bytes((x1 - x0) * 2)
+        for row in range(y0, y1):
+            start = (row * VRAM_WIDTH + x0) * 2
+            self.words[start:start + len(blank)] = blank
+
+    def _blit(self, rect, block_rect, data):
+        """Copy the part of a block that falls inside rect into VRAM"""
+        x0, y0, x1, y1 = rect
+        stride = (block_rect[2] - block_rect[0]) * 2
+        span = (x1 - x0) * 2
+        for row in range(y0, y1):
+            src = (row - block_rect[1]) * stride + (x0 - block_rect[0]) * 2
+            dst = (row * VRAM_WIDTH + x0) * 2
+            # Blocks read short of their data are left zero, as on load
+            chunk = data[src:src + span]
+            self.words[dst:dst + len(chunk)] = chunk
+
+    def _render(self, rect):
+        """Decode the words of a region into self.image"""
+        x0, y0, x1, y1 = rect
+        raw = bytearray()
+        for row in range(y0, y1):
+            start = (row * VRAM_WIDTH + x0) * 2
+            raw += self.words[start:start + (x1 - x0) * 2]
+
+        region = TimImage()._decode_16bit(raw, x1 - x0, y1 - y0)
+        self.image.paste(region, (x0, y0))